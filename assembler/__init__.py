@@ -0,0 +1,13 @@
+# RISC V assembler and disassembler
+# Importable without side effects - the command lines are in ass.py and dis.py
+
+# Example:
+
+# from assembler import assemble, disassemble, format_mc
+# result = assemble(["start: addi x1, x0, 5", "beq x1, x0, start"])
+# words  = machine_words(result)
+
+from .ass import (assemble, assemble_stream, tokenise, lex, machine_words,
+                  format_mc, format_bin, format_hex, renderers, ERROR,
+                  int_to_twos_complement, get_bits, instruction_table)
+from .dis import disassemble, twos_complement_to_int, sign_extend
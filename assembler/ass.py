@@ -25,7 +25,16 @@
 #        rather than the number of instructions
 
 
-import re
+import re, os, sys, json, time, argparse
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    from . import cache, sym
+except ImportError:
+    import cache, sym
+
+VERSION = "0.6"
 
 
 # Check for leading negative sign - no need to check for plus sign as that is removed as whitespace
@@ -48,36 +57,58 @@ def get_bits(value, start, end):
     mask = (1 << (end - start + 1)) -1
     return (value >> start) & mask
 
-def tokenise(txt) :
-    # remove () and [] and + that might surround / precede an integer
-    # make the left bracket and + into a space - for split()
-    # and remove the right brackets
-    # so:
-    # ld x0, x2(0) => ld x0 x2 0
-    # ld x0, x2+10 => ld x0 x2 10
-    
-    txt = txt.replace("[", " ")
-    txt = txt.replace("]","")
-    txt = txt.replace("(", " ")
-    txt = txt.replace(")","")
-    txt = txt.replace("+", " ")
-    txt = txt.lower()
-
-    # remove anything in braces {} - only allowed once in any line
-    l_brace = txt.find("{")
-    r_brace = txt.find("}")
-    if r_brace > -1 and l_brace > -1:
-        txt = txt[ : l_brace] + txt [r_brace + 1: ]
-
-    # process comments - anything from // to end of the line
-    comment = ""
-    comment_location = txt.find("//")
-    if comment_location != -1:
-        comment = txt[comment_location : ]
-        txt = txt[ : comment_location].strip()
-    
-    sp = re.split("[,\s]+", txt)
+# marks a line that could not be assembled
+ERROR = -1
+
+# Lexer - one precompiled regular expression splits a line into tokens in a
+# single left to right scan
+#
+# Separators are whitespace , ( ) [ ] and + - so these are all the same:
+# ld x0, x2(0)  ld x0, 0(x2)  ld x0, x2+0  ld x0 x2 [0]
+# Anything in braces {} is skipped, in a comment too, and a comment runs from // to the end of the line
+#
+# Each match skips leading separators then captures one of:
+# (comment, label definition, register number, integer, word)
+
+_SEP  = r"[\s,()\[\]+:]"
+_WORD = r"[^\s,()\[\]+{}:/]"
+
+_TOKEN_RE = re.compile(rf"""
+    {_SEP}*
+    (?: (//.*)
+      | ({_WORD}+):
+      | x(3[01]|[12][0-9]|[0-9])(?!{_WORD})
+      | (-?[0-9]+)(?!{_WORD})
+      | ({_WORD}+)
+      | \{{[^}}]*\}}
+    )
+""", re.VERBOSE)
+
+_BRACE_RE = re.compile(r"\{[^}]*\}")
 
+# Token types returned by lex()
+REGISTER  = "register"
+INTEGER   = "integer"
+LABEL     = "label"
+REFERENCE = "reference"
+MNEMONIC  = "mnemonic"
+COMMENT   = "comment"
+
+# returns a list of (token type, value) for a line, from the same scan as tokenise()
+def lex(txt):
+    tokens = []
+    tokenise(txt, tokens)
+    return tokens
+
+# The one classifier - the tokens of a line in the order the instruction uses them
+# the first word on a line is the mnemonic and any later word is a label reference
+# an integer before the mnemonic is a line number and is dropped
+# registers fill regA, regB and regC, the first integer is the value,
+# and a later register, integer or word is the jump label
+# It works straight from the regular expression matches as it is called for every line
+# tokens, if given, is filled with (token type, value) for lex()
+
+def tokenise(txt, tokens=None) :
     label = None	
     cmd   = None	
     regA  = None	
@@ -85,26 +116,53 @@ def tokenise(txt) :
     regC  = None	
     value = None
     jmp_label = None
+    comment = ""
 
-    for ind, c in enumerate(sp):
-        if len(c) > 0:             # don't process an empty cell
-            if ind == 0 and is_int(c):
-                # ignore line numbers
-                pass
-            elif c[-1] == ":":
-                label = c[:-1]
-            elif cmd == None:
-                cmd = c
-            elif regA == None and c[0] == "x" and is_uint(c[1:]):
-                regA = int(c[1])
-            elif regB == None and c[0] == "x" and is_uint(c[1:]):
-                regB = int(c[1])
-            elif regC == None and c[0] == "x" and is_uint(c[1:]):
-                regC = int(c[1])
-            elif value == None  and is_int(c):
-                value = int(c)
+    for comm, lab, reg, integer, word in _TOKEN_RE.findall(txt.lower()):
+        if reg:
+            if cmd == None:
+                cmd = "x" + reg
+                if tokens != None:
+                    tokens.append((MNEMONIC, cmd))
+                continue
+            reg = int(reg)
+            if regA == None:
+                regA = reg
+            elif regB == None:
+                regB = reg
+            elif regC == None:
+                regC = reg
             else:
-                jmp_label = c
+                jmp_label = f"x{reg:d}"
+            if tokens != None:
+                tokens.append((REGISTER, reg))
+        elif integer:
+            # an integer before the command is a line number
+            if cmd == None:
+                continue
+            elif value == None:
+                value = int(integer)
+            else:
+                jmp_label = integer
+            if tokens != None:
+                tokens.append((INTEGER, int(integer)))
+        elif word:
+            if cmd == None:
+                cmd = word
+                if tokens != None:
+                    tokens.append((MNEMONIC, cmd))
+            else:
+                jmp_label = word
+                if tokens != None:
+                    tokens.append((REFERENCE, word))
+        elif lab:
+            label = lab
+            if tokens != None:
+                tokens.append((LABEL, lab))
+        elif comm:
+            comment = _BRACE_RE.sub("", comm) if "{" in comm else comm
+            if tokens != None:
+                tokens.append((COMMENT, comment))
           
     return label, cmd, regA, regB, regC, value, jmp_label, comment
 
@@ -148,183 +206,1325 @@ def tokenise(txt) :
 # lui      ----------imm-------  --rgA 01101 11
 # auipc    ----------imm-------  --rgA 00101 11
 
-def assemble(code):
+# Instruction table - the only place an instruction is defined
+# mnemonic: (format, opcode, func3, func7, operand order as written)
+
+instruction_table = {
+    "lb":    ("I", 0b00000_11, 0, 0b0000000, "rd rs1 imm"),
+    "lh":    ("I", 0b00000_11, 1, 0b0000000, "rd rs1 imm"),
+    "lw":    ("I", 0b00000_11, 2, 0b0000000, "rd rs1 imm"),
+    "lbu":   ("I", 0b00000_11, 4, 0b0000000, "rd rs1 imm"),
+    "lhu":   ("I", 0b00000_11, 5, 0b0000000, "rd rs1 imm"),
+
+    "sb":    ("S", 0b01000_11, 0, 0b0000000, "rs2 rs1 imm"),
+    "sh":    ("S", 0b01000_11, 1, 0b0000000, "rs2 rs1 imm"),
+    "sw":    ("S", 0b01000_11, 2, 0b0000000, "rs2 rs1 imm"),
+
+    "add":   ("R", 0b01100_11, 0, 0b0000000, "rd rs1 rs2"),
+    "sub":   ("R", 0b01100_11, 0, 0b0100000, "rd rs1 rs2"),
+    "sll":   ("R", 0b01100_11, 1, 0b0000000, "rd rs1 rs2"),
+    "slt":   ("R", 0b01100_11, 2, 0b0000000, "rd rs1 rs2"),
+    "sltu":  ("R", 0b01100_11, 3, 0b0000000, "rd rs1 rs2"),
+    "xor":   ("R", 0b01100_11, 4, 0b0000000, "rd rs1 rs2"),
+    "srl":   ("R", 0b01100_11, 5, 0b0000000, "rd rs1 rs2"),
+    "sra":   ("R", 0b01100_11, 5, 0b0100000, "rd rs1 rs2"),
+    "or":    ("R", 0b01100_11, 6, 0b0000000, "rd rs1 rs2"),
+    "and":   ("R", 0b01100_11, 7, 0b0000000, "rd rs1 rs2"),
+
+    "addi":  ("I", 0b00100_11, 0, 0b0000000, "rd rs1 imm"),
+    "slti":  ("I", 0b00100_11, 2, 0b0000000, "rd rs1 imm"),
+    "sltiu": ("I", 0b00100_11, 3, 0b0000000, "rd rs1 imm"),
+    "xori":  ("I", 0b00100_11, 4, 0b0000000, "rd rs1 imm"),
+    "ori":   ("I", 0b00100_11, 6, 0b0000000, "rd rs1 imm"),
+    "andi":  ("I", 0b00100_11, 7, 0b0000000, "rd rs1 imm"),
+
+    "slli":  ("Ishift", 0b00100_11, 1, 0b0000000, "rd rs1 imm"),
+    "srli":  ("Ishift", 0b00100_11, 5, 0b0000000, "rd rs1 imm"),
+    "srai":  ("Ishift", 0b00100_11, 5, 0b0100000, "rd rs1 imm"),
+
+    "beq":   ("B", 0b11000_11, 0, 0b0000000, "rs1 rs2 imm"),
+    "bne":   ("B", 0b11000_11, 1, 0b0000000, "rs1 rs2 imm"),
+    "blt":   ("B", 0b11000_11, 4, 0b0000000, "rs1 rs2 imm"),
+    "bge":   ("B", 0b11000_11, 5, 0b0000000, "rs1 rs2 imm"),
+    "bltu":  ("B", 0b11000_11, 6, 0b0000000, "rs1 rs2 imm"),
+    "bgeu":  ("B", 0b11000_11, 7, 0b0000000, "rs1 rs2 imm"),
+
+    "jal":   ("J", 0b11011_11, 0, 0b0000000, "rd imm"),
+    "jalr":  ("I", 0b11001_11, 0, 0b0000000, "rd rs1 imm"),
+    "lui":   ("U", 0b01101_11, 0, 0b0000000, "rd imm"),
+    "auipc": ("U", 0b00101_11, 0, 0b0000000, "rd imm"),
+}
+
+# Immediate encoders - place a signed or unsigned value into the immediate bits of each format
+# masking with & gives the twos complement of a negative value
+
+def imm_I(value):
+    return (value & 0xfff) << 20
+
+def imm_Ishift(value):
+    return (value & 0x1f) << 20
+
+def imm_S(value):
+    return (get_bits(value, 5, 11) << 25) | (get_bits(value, 0, 4) << 7)
+
+def imm_B(value):
+    #         imm[12]    imm[10:5]      imm[4:1]   imm[11]            per spec
+    return ((get_bits(value, 12, 12) << 31) | (get_bits(value, 5, 10) << 25) |
+            (get_bits(value, 1, 4) << 8)    | (get_bits(value, 11, 11) << 7))
+
+def imm_J(value):
+    #         imm[20]    imm[10:1]      imm[11]    imm[19:12]         per spec
+    return ((get_bits(value, 20, 20) << 31) | (get_bits(value, 1, 10) << 21) |
+            (get_bits(value, 11, 11) << 20) | (get_bits(value, 12, 19) << 12))
+
+def imm_U(value):
+    return (value & 0xfffff) << 12
+
+imm_encoders = {"I": imm_I, "Ishift": imm_Ishift, "S": imm_S,
+                "B": imm_B, "J": imm_J, "U": imm_U}
+
+register_shift = {"rd": 7, "rs1": 15, "rs2": 20}
+
+# Build the encoder for one table entry
+# the encoder takes the operands in the order written: encode(regA, regB, regC, value)
+
+def make_encoder(fmt, opcode, func3, func7, operands):
+    fixed = (func7 << 25) | (func3 << 12) | opcode
+    regs = [register_shift[op] for op in operands.split() if op != "imm"]
+    imm = imm_encoders.get(fmt)
+
+    if len(regs) == 3:
+        shift_A, shift_B, shift_C = regs
+        def encode(regA, regB, regC, value):
+            return fixed | (regA << shift_A) | (regB << shift_B) | (regC << shift_C)
+    elif len(regs) == 2:
+        shift_A, shift_B = regs
+        def encode(regA, regB, regC, value):
+            return fixed | (regA << shift_A) | (regB << shift_B) | imm(value)
+    else:
+        shift_A, = regs
+        def encode(regA, regB, regC, value):
+            return fixed | (regA << shift_A) | imm(value)
+    return encode
+
+# one encoder per mnemonic, built once at import
+encoders = {cmd: make_encoder(*spec) for cmd, spec in instruction_table.items()}
+
+# Pseudo instructions - expanded in pass 1 into the instructions in the table above
+# Each template is (mnemonic, regA, regB, regC, immediate) where "A" and "B" are the
+# registers as written and "T" is the immediate or label as written
+# call and tail are a single jal as instruction memory is well within its +-1 MiB reach
+
+pseudo_table = {
+    "nop":  [("addi", 0,   0,   None, 0)],
+    "mv":   [("addi", "A", "B", None, 0)],
+    "not":  [("xori", "A", "B", None, -1)],
+    "neg":  [("sub",  "A", 0,   "B",  None)],
+    "seqz": [("sltiu", "A", "B", None, 1)],
+    "snez": [("sltu", "A", 0,   "B",  None)],
+    "sltz": [("slt",  "A", "B", 0,    None)],
+    "sgtz": [("slt",  "A", 0,   "B",  None)],
+
+    "j":    [("jal",  0,   None, None, "T")],
+    "jr":   [("jalr", 0,   "A",  None, 0)],
+    "ret":  [("jalr", 0,   1,    None, 0)],
+    "call": [("jal",  1,   None, None, "T")],
+    "tail": [("jal",  0,   None, None, "T")],
+
+    "beqz": [("beq",  "A", 0,   None, "T")],
+    "bnez": [("bne",  "A", 0,   None, "T")],
+    "blez": [("bge",  0,   "A", None, "T")],
+    "bgez": [("bge",  "A", 0,   None, "T")],
+    "bltz": [("blt",  "A", 0,   None, "T")],
+    "bgtz": [("blt",  0,   "A", None, "T")],
+    "bgt":  [("blt",  "B", "A", None, "T")],
+    "ble":  [("bge",  "B", "A", None, "T")],
+    "bgtu": [("bltu", "B", "A", None, "T")],
+    "bleu": [("bgeu", "B", "A", None, "T")],
+}
+
+# li rd, constant - the shortest sequence for the constant
+# one addi for 12 bits, one lui when the low 12 bits are 0, else lui then addi
+# addi sign extends its 12 bits, so lui takes the upper bits plus one when bit 11 is set
+# The constant is taken as 32 bits, so 0xffffffff is -1 and is a single addi
+
+def materialise(rd, constant):
+    constant = ((constant + (1 << 31)) & 0xffffffff) - (1 << 31)
+    if -2048 <= constant <= 2047:
+        return [("addi", rd, 0, None, constant, None)]
+    low = ((constant & 0xfff) ^ 0x800) - 0x800
+    upper = ((constant - low) >> 12) & 0xfffff
+    if low == 0:
+        return [("lui", rd, None, None, upper, None)]
+    return [("lui", rd, None, None, upper, None), ("addi", rd, rd, None, low, None)]
+
+# la rd, label - a single la, which is addi rd, x0, {absolute address of label}
+# code and data memory both start at 0 and are small enough for every address to fit
+encoders["la"] = make_encoder("I", 0b00100_11, 0, 0b0000000, "rd rs1 imm")
+
+# Returns [(cmd, regA, regB, regC, value, jmp_label)], or None if the operands do not fit
+def expand_pseudo(cmd, regA, regB, value, jmp_label):
+    if cmd == "li" or (cmd == "la" and not jmp_label):
+        if regA == None:
+            return None
+        if value == None:
+            try:
+                value = int(jmp_label, 0)
+            except (TypeError, ValueError):
+                return None
+        return materialise(regA, value)
+    if cmd == "la":
+        return [("la", regA, 0, None, None, jmp_label)] if regA != None else None
+
+    expansion = []
+    for op, *operands in pseudo_table[cmd]:
+        regs = []
+        for operand in operands[:3]:
+            if operand == "A":
+                operand = regA
+                if regA == None:
+                    return None
+            elif operand == "B":
+                operand = regB
+                if regB == None:
+                    return None
+            regs.append(operand)
+        if operands[3] == "T":
+            expansion.append((op, *regs, value, jmp_label))
+        else:
+            expansion.append((op, *regs, operands[3], None))
+    return expansion
+
+pseudo_cmds = set(pseudo_table) | {"li", "la"}
+
+# The instructions for one line - [(cmd, regA, regB, regC, value, jmp_label)]
+# a pseudo instruction is expanded, and one whose operands do not fit is left as
+# written so it encodes as ERROR
+def line_instructions(cmd, regA, regB, regC, value, jmp_label):
+    if cmd in pseudo_cmds:
+        expansion = expand_pseudo(cmd, regA, regB, value, jmp_label)
+        if expansion:
+            return expansion
+    return [(cmd, regA, regB, regC, value, jmp_label)]
+
+# Data directives
+# .data and .text switch section - code is always assembled from address 0
+# and so is data, as data memory is a separate memory
+# In the .data section:
+# .word v, v ...    32 bit values        .half v ...   16 bit values
+# .byte v ...       8 bit values         .space n {, fill}   n bytes of fill (default 0)
+# .align n          pad with 0 to a multiple of 2^n bytes
+# Values are little endian, and may be decimal or 0x hex or 0b binary
+# A label in the .data section is the absolute data address, not pc relative,
+# so lw x1, counter(x0) loads from counter
+
+data_sizes = {".word": 4, ".half": 2, ".byte": 1}
+
+def directive_values(line):
+    values = []
+    for kind, token in lex(line):
+        if kind == INTEGER:
+            values.append(token)
+        elif kind == REFERENCE:
+            values.append(int(token, 0))
+        elif kind == REGISTER:
+            raise ValueError("register in a directive")
+    return values
+
+# Add one directive's bytes to the data image
+def lay_out_data(cmd, values, image):
+    if cmd in data_sizes and values:
+        size = data_sizes[cmd]
+        mask = (1 << (size * 8)) - 1
+        for value in values:
+            image += (value & mask).to_bytes(size, "little")
+    elif cmd == ".space" and 1 <= len(values) <= 2:
+        fill = values[1] if len(values) == 2 else 0
+        image += bytes([fill & 0xff]) * values[0]
+    elif cmd == ".align" and len(values) == 1:
+        image += bytes(-len(image) % (1 << values[0]))
+    else:
+        raise ValueError(f"bad directive {cmd:s}")
+
+# Range checks - a branch reaches +-4 KiB and jal +-1 MiB, in multiples of 2 bytes
+# an offset outside that would lose its high bits, so the line is an ERROR instead
+
+# la is an absolute address in a 12 bit immediate
+# limits are (lowest, highest, multiple of)
+
+format_limits = {"B": (-1 << 12, (1 << 12) - 2, 2), "J": (-1 << 20, (1 << 20) - 2, 2)}
+offset_limits = {cmd: format_limits[spec[0]] for cmd, spec in instruction_table.items() if spec[0] in format_limits}
+offset_limits["la"] = (-2048, 2047, 1)
+
+def in_range(limits, value):
+    low, high, multiple = limits
+    return low <= value <= high and value % multiple == 0
+
+# these take the absolute address of a code label rather than the pc relative offset
+absolute_cmds = {"la"}
+
+# The word for one instruction, or ERROR for an unknown mnemonic or an offset out of range
+def encode_line(cmd, regA, regB, regC, value):
+    encode = encoders.get(cmd)
+    if not encode or (cmd in offset_limits and value != None and not in_range(offset_limits[cmd], value)):
+        return ERROR
+    return encode(regA, regB, regC, value)
+
+# Pass 2 over a list of ir entries - each line only needs the label table and its own address
+# each result entry is (address, label, word, comment)
+# where word is the 32 bit instruction, None for no instruction or ERROR
+
+def encode_ir(ir, label_to_line, data_labels={}):
     result = []
+    for (source_line, line_number, label, cmd, regA, regB, regC, value, jmp_label, comment) in ir:
+        word = None
+
+        # Replace a jump label with the value - a data label is an absolute address
+        if jmp_label:
+            if jmp_label in label_to_line:
+                value = label_to_line[jmp_label]
+                if cmd not in absolute_cmds:
+                    value -= line_number
+            else:
+                value = data_labels[jmp_label]
+           
+        if cmd:
+            word = encode_line(cmd, regA, regB, regC, value)
+
+        result.append((line_number, label, word, comment))
+            
+    return result
+
+# Parallel pass 2 - the label table is sent once to each worker process
+# and the chunks of ir are encoded in the workers and returned in order
+
+worker_labels = None
+worker_data_labels = None
+
+def init_worker(label_to_line, data_labels={}):
+    global worker_labels, worker_data_labels
+    worker_labels = label_to_line
+    worker_data_labels = data_labels
+
+def encode_chunk(chunk):
+    return encode_ir(chunk, worker_labels, worker_data_labels)
+
+def encode_parallel(ir, label_to_line, workers, chunk_size=None, data_labels={}):
+    if chunk_size == None:
+        chunk_size = max(1, len(ir) // (workers * 4))
+    chunks = [ir[i : i + chunk_size] for i in range(0, len(ir), chunk_size)]
+
+    result = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(label_to_line, data_labels)) as executor:
+        for part in executor.map(encode_chunk, chunks):
+            result += part
+    return result
+
+# .include "file" - the lines of file are assembled in place of the directive
+# the name is relative to the including file, or the current directory if that is not known
+# Included files are tokenised once per process and reused until their mtime changes,
+# so a batch run reads shared setup code once rather than once per program
+# Included lines take the source line number of the .include in the top level file
+# A label on the .include line labels the first included instruction
+
+# the tokens of a line with only a label on it
+def label_tokens(label):
+    return label, None, None, None, None, None, None, ""
+
+_INCLUDE_RE = re.compile(r'\.include\s+"([^"]+)"', re.IGNORECASE)
+
+# path: (mtime, [(line, tokens)])
+include_cache = {}
+
+def tokenise_file(path):
+    mtime = os.stat(path).st_mtime_ns
+    cached = include_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    f = open(path, mode='r')
+    lines = [(line, tokenise(line)) for line in (line.strip() for line in f)]
+    f.close()
+    include_cache[path] = (mtime, lines)
+    return lines
+
+def included_tokens(line, directory, source_line, including):
+    match = _INCLUDE_RE.search(line)
+    if not match:
+        raise ValueError(f"line {source_line + 1:d}: .include needs a file name in double quotes")
+    path = os.path.realpath(os.path.join(directory, match.group(1)))
+    if path in including:
+        raise ValueError(f"line {source_line + 1:d}: include cycle " + " -> ".join(including + (path,)))
+    try:
+        lines = tokenise_file(path)
+    except OSError as e:
+        raise ValueError(f"line {source_line + 1:d}: cannot include {path:s}: {e.strerror}")
+    for line, tokens in lines:
+        if tokens[1] == ".include":
+            if tokens[0]:
+                yield source_line, line, label_tokens(tokens[0])
+            yield from included_tokens(line, os.path.dirname(path), source_line, including + (path,))
+        else:
+            yield source_line, line, tokens
+
+# yields (source line, line, tokens) with the included files expanded
+
+def source_tokens(code, filename=None):
+    directory = os.path.dirname(filename) if filename else ""
+    including = (os.path.realpath(filename),) if filename else ()
+    for source_line, line in enumerate(code):
+        tokens = tokenise(line)
+        if tokens[1] == ".include":
+            if tokens[0]:
+                yield source_line, line, label_tokens(tokens[0])
+            yield from included_tokens(line, directory, source_line, including)
+        else:
+            yield source_line, line, tokens
+
+# Pass 1 - returns (ir, label_to_line, data_labels)
+# data is a bytearray the .data section is laid out into - it is discarded if not given
+# filename is the source file, to find included files from
+# a bad data directive or include raises ValueError
+
+def build_ir(code, data=None, filename=None):
     label_to_line = {}
     line_to_label = {}
-    
-    old_arith_cmds = {"add": 2, "sub": 3, "lsl": 5,
-                  "lsr": 6, "and": 7, "or" : 8,
-                  "slt": 9}
-
-    arith_r_cmds = {"add": 0, "sub": 8, "sll": 1,
-                    "slt": 2, "sltu": 3, "xor" : 4,
-                    "srl": 5, "sra": 13, "or": 6 , "and": 7}
-
-    arith_i_cmds = {"addi": 0,  "slti": 2, "sltiu": 3, 
-                    "xori": 4, "ori": 6 , "andi": 7}
-                    
-    arith_i_shift_cmds = {"slli": 1, "srli": 5, "srai": 13}
-    
-    load_cmds =    {"lb": 0, "lh": 1, "lw": 2, "lbu": 4, "lhu": 5}
-    store_cmds =   {"sb": 0, "sh": 1, "sw": 2}
-    branch_cmds =  {"beq": 0, "bne": 1, "blt": 4, "bge": 5, "bltu":6, "bgeu": 7}
-        
-    # Pass 1 - for labels
+    data_labels = {}
+    if data == None:
+        data = bytearray()
+    in_data = False
+
+    # Pass 1 - tokenise each line once, collect labels and build the
+    # intermediate representation that pass 2 works from
+    # ir entry: (source line, address, label, cmd, regA, regB, regC, value, jmp_label, comment)
+    ir = []
     line_number = 0
-    for line in code:
-        (label, cmd, regA, regB, regC, value, jmp_label, comment) = tokenise(line)
+    for source_line, line, tokens in source_tokens(code, filename):
+        (label, cmd, regA, regB, regC, value, jmp_label, comment) = tokens
+        if cmd == ".data" or cmd == ".text":
+            in_data = cmd == ".data"
+            cmd = None
+        if in_data:
+            if label:
+                data_labels[label] = len(data)
+                label = None
+            if cmd:
+                try:
+                    if cmd[0] != ".":
+                        raise ValueError(f"{cmd:s} in the .data section")
+                    lay_out_data(cmd, directive_values(line), data)
+                except ValueError as e:
+                    raise ValueError(f"line {source_line + 1:d}: {e}")
+                cmd = None
         if label:
             label_to_line[label] = line_number
             line_to_label[line_number] = label
         if cmd:
-            line_number += 4
+            # the label and comment go on the first instruction
+            for (cmd, regA, regB, regC, value, jmp_label) in line_instructions(cmd, regA, regB, regC, value, jmp_label):
+                ir.append((source_line, line_number, label, cmd, regA, regB, regC, value, jmp_label, comment))
+                line_number += 4
+                label = None
+                comment = ""
+        elif label or comment:
+            ir.append((source_line, line_number, label, cmd, regA, regB, regC, value, jmp_label, comment))
+
+    ir, label_to_line = relax(ir, label_to_line)
+    return ir, label_to_line, data_labels
+
+# Branch relaxation
+# A conditional branch to a label out of its range is rewritten as the inverted
+# branch over a jal, which reaches +-1 MiB:
+#     beq x1, x2, far     becomes     bne x1, x2, 8
+#                                     jal x0, far
+# Expanding a branch moves the code after it, which can push other branches out of
+# range, so the layout is repeated until no more need expanding
+# Branches start short and only ever grow, so this stops with the fewest expanded
+
+inverted_branch = {"beq": "bne", "bne": "beq", "blt": "bge", "bge": "blt", "bltu": "bgeu", "bgeu": "bltu"}
+
+# returns the address of each ir entry, with the entries in long_branches taking two words,
+# and the label table for that layout
+def lay_out(ir, long_branches):
+    addresses = []
+    label_to_line = {}
+    address = 0
+    for index, entry in enumerate(ir):
+        addresses.append(address)
+        if entry[2]:
+            label_to_line[entry[2]] = address
+        if entry[3]:
+            address += 8 if index in long_branches else 4
+    return addresses, label_to_line
+
+# returns (ir, label_to_line) - the same lists if no branch is out of range
+def relax(ir, label_to_line):
+    branches = [index for index, entry in enumerate(ir) if entry[3] in inverted_branch and entry[8]]
+    addresses = [entry[1] for entry in ir]
+    long_branches = set()
+    while True:
+        far = {index for index in branches if index not in long_branches and ir[index][8] in label_to_line
+               and not in_range(offset_limits[ir[index][3]], label_to_line[ir[index][8]] - addresses[index])}
+        if not far:
+            break
+        long_branches |= far
+        addresses, label_to_line = lay_out(ir, long_branches)
+
+    if not long_branches:
+        return ir, label_to_line
+    relaxed = []
+    for index, (source_line, address, label, cmd, regA, regB, regC, value, jmp_label, comment) in enumerate(ir):
+        address = addresses[index]
+        if index in long_branches:
+            relaxed.append((source_line, address, label, inverted_branch[cmd], regA, regB, None, 8, None, comment))
+            relaxed.append((source_line, address + 4, None, "jal", 0, None, None, None, jmp_label, ""))
+        else:
+            relaxed.append((source_line, address, label, cmd, regA, regB, regC, value, jmp_label, comment))
+    return relaxed, label_to_line
+
+# Pass 2 - workers > 1 splits it across that many processes, worthwhile for very large sources only
+
+def encode_pass(ir, label_to_line, data_labels={}, workers=1):
+    if workers > 1:
+        return encode_parallel(ir, label_to_line, workers, data_labels=data_labels)
+    return encode_ir(ir, label_to_line, data_labels)
+
+def assemble(code, workers=1, data=None, filename=None):
+    ir, label_to_line, data_labels = build_ir(code, data, filename)
+    return encode_pass(ir, label_to_line, data_labels, workers)
+
+
+# Relocatable object - assembled on its own, then combined with others by link.py
+# A reference to a label the source does not define is left as a relocation for the
+# linker, and so is every reference to a data label, as the linker moves the data
+# References to code labels in the same source are pc relative so never need one
+#
+# The object is a dict, written as JSON to a .rso file:
+# result       the assemble() result, as lists
+# text_bytes   size of the code
+# data         the data image as hex
+# symbols      {"text": {label: address}, "data": {label: address}}
+# relocations  [result index, immediate format, kind, label or address] where kind is
+#              "symbol"  a label in another object, pc relative if it is code
+#              "data"    an address in this object's data
+#              "text"    an address in this object's code, for la
+#              "address" the absolute address of a label in another object, for la
+
+OBJECT_VERSION = 1
+
+def object_from_ir(ir, label_to_line, data_labels, data):
+    relocations = []
+    placeholders = {}
+    for index, entry in enumerate(ir):
+        cmd, jmp_label = entry[3], entry[8]
+        if not jmp_label:
+            continue
+        if cmd in absolute_cmds:
+            if jmp_label in label_to_line:
+                relocations.append([index, "I", "text", label_to_line[jmp_label]])
+                continue
+            kind = "address"
+        elif jmp_label in label_to_line or cmd not in instruction_table:
+            continue
+        else:
+            kind = "symbol"
+        fmt = instruction_table[cmd][0] if cmd in instruction_table else "I"
+        if jmp_label in data_labels:
+            relocations.append([index, fmt, "data", data_labels[jmp_label]])
+        else:
+            relocations.append([index, fmt, kind, jmp_label])
+        placeholders[jmp_label] = 0
+
+    result = encode_ir(ir, label_to_line, placeholders)
+    text_bytes = sum(4 for entry in result if entry[2] != None)
+    return {"version": OBJECT_VERSION, "result": [list(entry) for entry in result],
+            "text_bytes": text_bytes, "data": bytes(data).hex(),
+            "symbols": {"text": label_to_line, "data": data_labels},
+            "relocations": relocations}
+
+def assemble_object(code, filename=None):
+    data = bytearray()
+    return object_from_ir(*build_ir(code, data, filename), data)
+
+
+# Number of leading lines two lists have in common
+# compares blocks of lines as slices first, which is much faster than line by line
+
+def common_prefix(a, b, block=1024):
+    limit = min(len(a), len(b))
+    start = 0
+    while start + block <= limit and a[start : start + block] == b[start : start + block]:
+        start += block
+    while start < limit and a[start] == b[start]:
+        start += 1
+    return start
+
+# Incremental assembly - for re-assembling a source after a small edit
+#
+# assemble_incremental(code) assembles in full and returns (result, state)
+# assemble_incremental(new_code, state) re-uses the ir and label table in state
+# The old and new source are compared to find the edited block of lines - only those
+# are tokenised and encoded again, plus any label reference whose pc relative offset
+# has moved because the edit changed the number of instructions or moved a label,
+# or la whose label has moved
+# Pseudo instructions are expanded as by build_ir(), so a line can be several instructions
+#
+# state is a dict:
+# code      - the source lines
+# ir        - [ir entries] for each source line, None for a blank line
+# address   - address of each source line, with the end address appended
+# labels    - label_to_line
+# result    - [result entries] for each source line, None for a blank line
+# encoded   - how many lines were encoded by the last call
+# relaxed   - True if a branch was relaxed, so the next call assembles in full
+# A line whose operands cannot be encoded, such as a half typed addi x1, raises
+# ValueError naming the line, and a reference to an unknown label raises KeyError
+# - state is only returned on success, so the last good state can be used again
+# Directives (.data, .word, .include ...) raise ValueError - only code is re-assembled
+# Branch relaxation moves the code after a branch, which this cannot follow, so if an
+# edit leaves a branch out of range, or the last assembly relaxed one, the whole
+# source is assembled again with build_ir() - the result always matches assemble()
+
+# encode_ir() for the entries of one source line
+def encode_line_entries(entries, label_to_line, code, i):
+    try:
+        return encode_ir(entries, label_to_line)
+    except (TypeError, ValueError):
+        raise ValueError(f"line {i + 1:d} cannot be assembled: {code[i]:s}")
+
+# The state for the whole source assembled by build_ir(), with any branches relaxed
+def full_state(code):
+    for source_line, line in enumerate(code):
+        cmd = tokenise(line)[1]
+        if cmd and cmd[0] == ".":
+            raise ValueError(f"line {source_line + 1:d}: {cmd:s} cannot be assembled incrementally")
+    ir, label_to_line, data_labels = build_ir(code)
 
-    # Pass 2 - assembly
+    line_ir = [None] * len(code)
+    for entry in ir:
+        if line_ir[entry[0]] == None:
+            line_ir[entry[0]] = []
+        line_ir[entry[0]].append(entry)
+    address = []
     line_number = 0
-    for line in code:
-        (label, cmd, regA, regB, regC, value, jmp_label, comment) = tokenise(line)
-        code = ""
-        
-        # Replace a jump label with the value
-        if jmp_label:
-            value = label_to_line[jmp_label] - line_number
-           
+    for entries in line_ir:
+        address.append(line_number)
+        for entry in entries or []:
+            if entry[3]:
+                line_number = entry[1] + 4
+    address.append(line_number)
+
+    result = [entries and encode_line_entries(entries, label_to_line, code, i) for i, entries in enumerate(line_ir)]
+    # a relaxed branch is the inverted branch then a jal, from the one source line
+    relaxed = any(entries and any(entry[3] in inverted_branch and entry[8] == None and
+                                  n + 1 < len(entries) and entries[n + 1][3] == "jal"
+                                  for n, entry in enumerate(entries))
+                  for entries in line_ir)
+    state = {"code": list(code), "ir": line_ir, "address": address, "labels": label_to_line,
+             "result": result, "encoded": len(code), "relaxed": relaxed}
+    return [entry for entries in result if entries for entry in entries], state
+
+def assemble_incremental(code, state=None):
+    if state == None:
+        state = {"code": [], "ir": [], "address": [0], "labels": {}, "result": []}
+    if state.get("relaxed"):
+        return full_state(code)
+    old_code    = state["code"]
+    old_ir      = state["ir"]
+    old_address = state["address"]
+    old_labels  = state["labels"]
+    old_result  = state["result"]
+
+    # find the edited block - everything before start and after the end is unchanged
+    start = common_prefix(old_code, code)
+    tail = common_prefix(old_code[start:][::-1], code[start:][::-1])
+    old_end = len(old_code) - tail
+    new_end = len(code) - tail
+
+    # tokenise the edited lines
+    mid_ir = []
+    mid_address = []
+    line_number = old_address[start]
+    for source_line in range(start, new_end):
+        (label, cmd, regA, regB, regC, value, jmp_label, comment) = tokenise(code[source_line])
+        if cmd and cmd[0] == ".":
+            raise ValueError(f"line {source_line + 1:d}: {cmd:s} cannot be assembled incrementally")
+        mid_address.append(line_number)
         if cmd:
-            if   cmd in load_cmds:
-                imm = int_to_twos_complement(value, 12)
-                imm_11_0 = get_bits(imm, 0,  11)
-                dw = load_cmds[cmd]
-                code = f"   {imm_11_0:012b}_{regB:05b}_{dw:03b}_{regA:05b}_00000_11"
-            elif cmd in store_cmds:
-                imm = int_to_twos_complement(value, 12)
-                imm_11_5 = get_bits(imm, 5,  11)
-                imm_4_0  = get_bits(imm, 0,  4)
-                dw = store_cmds[cmd]
-                code = f"  {imm_11_5:07b}_{regA:05b}_{regB:05b}_{dw:03b}_{imm_4_0:05b}_01000_11"
-            elif cmd in arith_r_cmds:
-                val = arith_r_cmds[cmd]
-                func7 = (val >> 3) & 1
-                func3 = val & 7
-                code = f"  0{func7:01b}00000_{regC:05b}_{regB:05b}_{func3:03b}_{regA:05b}_01100_11"
-            elif cmd in arith_i_cmds:
-                imm = int_to_twos_complement(value, 12)
-                imm_11_0 = get_bits(imm, 0,  11) 
-                val = arith_i_cmds[cmd]
-                func7 = (val >> 3) & 1
-                func3 = val & 7
-                code = f"   {imm_11_0:012b}_{regB:05b}_{func3:03b}_{regA:05b}_00100_11"
-            elif cmd in arith_i_shift_cmds:
-                imm = int_to_twos_complement(value, 5)
-                imm_0_4 = get_bits(imm, 0,  4) 
-                val = arith_i_shift_cmds[cmd]
-                func7 = (val >> 3) & 1
-                func3 = val & 7
-                code = f"  0{func7:01b}00000_{imm_0_4:05b}_{regB:05b}_{func3:03b}_{regA:05b}_00100_11"               
-            elif cmd in branch_cmds:
-                #         imm[12]    imm[10:5]      imm[4:1]   imm[11]            per spec
-                # get 13 bit twos complement as we drop the final bit
-                imm = int_to_twos_complement(value, 13)
-                imm_12   = get_bits(imm, 12, 12)
-                imm_10_5 = get_bits(imm, 5,  10)
-                imm_4_1  = get_bits(imm, 1,  4)
-                imm_11   = get_bits(imm, 11, 11)
-                func3 = branch_cmds[cmd]
-                code = f"{imm_12:01b}_{imm_10_5:06b}_{regB:05b}_{regA:05b}_{func3:03b}_{imm_4_1:04b}_{imm_11:01b}_11000_11"
-            elif cmd == "jal":
-                #         imm[20]    imm[10:1]      imm[11]    imm[19:12]         per spec
-                # get 21 bit twos complement as we drop the final bit
-                imm = int_to_twos_complement(value, 21)
-                imm_20    = get_bits(imm, 20, 20)
-                imm_10_1  = get_bits(imm, 1,  10)
-                imm_11    = get_bits(imm, 11, 11)
-                imm_19_12 = get_bits(imm, 12, 19)
-                code = f"  {imm_20:01b}_{imm_10_1:010b}_{imm_11:01b}_{imm_19_12:08b}_{regA:05b}_11011_11"                
-            elif cmd == "jalr":
-                imm = int_to_twos_complement(value, 12)
-                imm_11_0 = get_bits(imm, 0,  11)
-                code = f"   {imm_11_0:012b}_{regB:05b}_000_{regA:05b}_11001_11"
-            elif cmd == "auipc":
-                imm = int_to_twos_complement(value, 20)
-                imm_19_0 = get_bits(imm, 0,  19)
-                code = f"     {imm_19_0:020b}_{regA:05b}_00101_11"
-            elif cmd == "lui":
-                imm = int_to_twos_complement(value, 20)
-                imm_19_0 = get_bits(value, 0,  19)
-                code = f"     {imm_19_0:020b}_{regA:05b}_01101_11"
-            else:
-                code = "ERROR"
-                
-        result.append((line_number, label, code, comment))
-        if code:
+            entries = []
+            for (cmd, regA, regB, regC, value, jmp_label) in line_instructions(cmd, regA, regB, regC, value, jmp_label):
+                entries.append((source_line, line_number, label, cmd, regA, regB, regC, value, jmp_label, comment))
+                line_number += 4
+                label = None
+                comment = ""
+            mid_ir.append(entries)
+        elif label or comment:
+            mid_ir.append([(source_line, line_number, label, cmd, regA, regB, regC, value, jmp_label, comment)])
+        else:
+            mid_ir.append(None)
+
+    line_delta = (new_end - start) - (old_end - start)
+    address_delta = line_number - old_address[old_end]
+
+    # the lines after the edit move by line_delta and address_delta
+    suffix_ir = old_ir[old_end:]
+    suffix_address = old_address[old_end:]
+    suffix_result = old_result[old_end:]
+    if line_delta or address_delta:
+        suffix_ir = [entries and [(entry[0] + line_delta, entry[1] + address_delta) + entry[2:] for entry in entries]
+                     for entries in suffix_ir]
+    if address_delta:
+        suffix_address = [a + address_delta for a in suffix_address]
+        suffix_result = [entries and [(entry[0] + address_delta,) + entry[1:] for entry in entries]
+                         for entries in suffix_result]
+
+    ir = old_ir[:start] + mid_ir + suffix_ir
+    address = old_address[:start] + mid_address + suffix_address
+    result = old_result[:start] + [None] * len(mid_ir) + suffix_result
+
+    # label table - only rebuilt if the edit moved the later lines or touched a label
+    # (rebuilding keeps the last definition of a repeated label, as assemble() does)
+    if address_delta or any(entries and entries[0][2] for entries in old_ir[start:old_end] + mid_ir):
+        label_to_line = {entries[0][2]: entries[0][1] for entries in ir if entries and entries[0][2]}
+    else:
+        label_to_line = old_labels
+    moved = {label for label in old_labels.keys() | label_to_line.keys()
+             if old_labels.get(label) != label_to_line.get(label)}
+
+    # lines to encode - the edited block, then any other label reference whose offset changed
+    todo = list(range(start, new_end))
+    if moved or address_delta:
+        for i, entries in enumerate(ir):
+            if start <= i < new_end or not entries:
+                continue
+            for entry in entries:
+                jmp_label = entry[8]
+                if not jmp_label:
+                    continue
+                if entry[3] in absolute_cmds:
+                    changed = jmp_label in moved
+                elif jmp_label in moved or (i >= new_end and address_delta):
+                    old_offset = old_labels.get(jmp_label, 0) - (entry[1] - (address_delta if i >= new_end else 0))
+                    changed = label_to_line.get(jmp_label, 0) - entry[1] != old_offset or jmp_label not in label_to_line
+                else:
+                    changed = False
+                if changed:
+                    todo.append(i)
+                    break
+    todo = [i for i in todo if ir[i]]
+
+    for i in todo:
+        result[i] = encode_line_entries(ir[i], label_to_line, code, i)
+        for entry, encoded in zip(ir[i], result[i]):
+            if encoded[2] == ERROR and entry[3] in inverted_branch and entry[8] in label_to_line:
+                # a branch out of range - relax it as assemble() would
+                return full_state(code)
+
+    state = {"code": list(code), "ir": ir, "address": address, "labels": label_to_line,
+             "result": result, "encoded": len(todo), "relaxed": False}
+    return [entry for entries in result if entries for entry in entries], state
+
+
+# Streaming assembly for sources too large to hold in memory
+#
+# A generator version of assemble() - each line is encoded as soon as it is read
+# A forward reference is encoded with an offset of 0 and its entry carries a fixup
+# (cmd, regA, regB, regC, jmp_label) so the word can be rebuilt once the label is known
+# Offsets are range checked as in encode_ir(), when encoded and again when backpatched,
+# but a branch out of range cannot be relaxed in a single pass so is an ERROR
+# Pseudo instructions are expanded as by build_ir()
+# label_to_line is filled in as the labels are seen
+# yields (address, label, word, comment, fixup)
+# Only code is streamed - a directive (.data, .word, .include ...) raises ValueError
+
+def assemble_stream(lines, label_to_line):
+    line_number = 0
+    for source_line, line in enumerate(lines):
+        (label, cmd, regA, regB, regC, value, jmp_label, comment) = tokenise(line.strip())
+        if cmd and cmd[0] == ".":
+            raise ValueError(f"line {source_line + 1:d}: {cmd:s} cannot be streamed")
+        if label:
+            label_to_line[label] = line_number
+        if not (label or cmd or comment):
+            continue
+
+        if not cmd:
+            yield (line_number, label, None, comment, None)
+            continue
+
+        # the label and comment go on the first instruction
+        for (cmd, regA, regB, regC, value, jmp_label) in line_instructions(cmd, regA, regB, regC, value, jmp_label):
+            fixup = None
+            if jmp_label and cmd in encoders:
+                if jmp_label in label_to_line:
+                    value = label_to_line[jmp_label]
+                    if cmd not in absolute_cmds:
+                        value -= line_number
+                else:
+                    value = 0
+                    fixup = (cmd, regA, regB, regC, jmp_label)
+            yield (line_number, label, encode_line(cmd, regA, regB, regC, value), comment, fixup)
             line_number += 4
-            
-    return result
+            label = None
+            comment = ""
+
+def resolve_fixup(line_number, fixup, label_to_line):
+    (cmd, regA, regB, regC, jmp_label) = fixup
+    value = label_to_line[jmp_label]
+    if cmd not in absolute_cmds:
+        value -= line_number
+    return encode_line(cmd, regA, regB, regC, value)
+
+
+# Output renderers - turn a 32 bit word into text
+# assemble() only produces integers, the text format is chosen when writing
+
+# Binary with underscores between the instruction fields, as used in .mc and .lmc
+# opcode: (leading spaces, field widths from the msb)
+
+mc_layout = {0b00000_11: ("   ", (12, 5, 3, 5, 5, 2)),
+             0b01000_11: ("  ",  (7, 5, 5, 3, 5, 5, 2)),
+             0b01100_11: ("  ",  (7, 5, 5, 3, 5, 5, 2)),
+             0b00100_11: ("   ", (12, 5, 3, 5, 5, 2)),
+             0b11000_11: ("",    (1, 6, 5, 5, 3, 4, 1, 5, 2)),
+             0b11011_11: ("  ",  (1, 10, 1, 8, 5, 5, 2)),
+             0b11001_11: ("   ", (12, 5, 3, 5, 5, 2)),
+             0b00101_11: ("     ", (20, 5, 5, 2)),
+             0b01101_11: ("     ", (20, 5, 5, 2))}
+
+# the immediate shifts show func7 and the shift amount separately
+mc_shift_layout = ("  ", (7, 5, 5, 3, 5, 5, 2))
+
+def format_mc(word):
+    if word == ERROR:
+        return "ERROR"
+    opcode = get_bits(word, 0, 6)
+    func3  = get_bits(word, 12, 14)
+    if opcode == 0b00100_11 and (func3 == 1 or func3 == 5):
+        spaces, widths = mc_shift_layout
+    else:
+        spaces, widths = mc_layout.get(opcode, ("", (32,)))
+    bits = f"{word:032b}"
+    fields = []
+    start = 0
+    for width in widths:
+        fields.append(bits[start : start + width])
+        start += width
+    return spaces + "_".join(fields)
+
+def format_bin(word):
+    if word == ERROR:
+        return "ERROR"
+    return f"{word:032b}"
+
+def format_hex(word):
+    if word == ERROR:
+        return "ERROR"
+    return f"{word:08x}"
+
+renderers = {"mc": format_mc, "bin": format_bin, "hex": format_hex}
+
+# The instruction words from an assemble() result, in address order
+# An ERROR line becomes 0 which is always an illegal instruction in RISC-V
+
+def machine_words(result):
+    words = array("I")
+    for line_number, label, word, comment in result:
+        if word == ERROR:
+            words.append(0)
+        elif word != None:
+            words.append(word)
+    return words
+
+# The .mc and .lmc text for an assemble() result
+# returns (mc lines, lmc lines) - the .lmc lines are also what goes to the screen
+
+def mc_listing(result):
+    mc = []
+    lmc = []
+    for line_no, label, word, comment in result:
+        if label:
+            s = f"// [{label:s}:{line_no:d}]"
+            mc.append(s)
+            lmc.append(s)
+
+        if comment and word == None:
+            s = f"       {comment:s}"
+            mc.append(s)
+            lmc.append(s)
+
+        if word != None:
+            code = format_mc(word)
+            mc.append(f"        {code:22s} {comment:s}")
+            lmc.append(f"{line_no:<4d}    {code:22s} {comment:s}")
+    return mc, lmc
+
+# Other output formats - written straight from the instruction words
+
+# $readmemh text - one 8 digit hex word per line, labels as comments
+# a quarter of the size of .mc and quicker for the simulator to read
+
+def readmemh_listing(result):
+    lines = []
+    for line_no, label, word, comment in result:
+        if label:
+            lines.append(f"// [{label:s}:{line_no:d}]")
+        if word == ERROR:
+            lines.append("00000000")
+        elif word != None:
+            lines.append(f"{word:08x}")
+    return lines
+
+# Raw binary image - each word as 4 bytes, little endian as RISC V stores them
+
+def binary_image(words):
+    image = array("I", words)
+    if sys.byteorder == "big":
+        image.byteswap()
+    return image.tobytes()
+
+# Intel HEX - 16 byte data records, with an extended linear address record
+# whenever the upper 16 bits of the address change, then the end of file record
+
+def ihex_record(address, record_type, data):
+    record = bytes([len(data), (address >> 8) & 0xff, address & 0xff, record_type]) + data
+    checksum = (-sum(record)) & 0xff
+    return ":" + record.hex().upper() + f"{checksum:02X}"
+
+def intel_hex(words, address=0):
+    image = binary_image(words)
+    lines = []
+    upper = None
+    for offset in range(0, len(image), 16):
+        record_address = address + offset
+        if record_address >> 16 != upper:
+            upper = record_address >> 16
+            lines.append(ihex_record(0, 0x04, upper.to_bytes(2, "big")))
+        lines.append(ihex_record(record_address & 0xffff, 0x00, image[offset : offset + 16]))
+    lines.append(ihex_record(0, 0x01, b""))
+    return lines
+
+# Data memory files for $readmemb in data_memory.v
+# The data image is padded to whole words and split into the four byte banks with
+# one slice each - bank A is the most significant byte of each word, D the least
+# Each bank file has one 8 bit binary byte per line, the word file one word per line
+# with an underscore between the bytes
+
+byte_bits = [f"{i:08b}" for i in range(256)]
+
+def pad_to_words(image):
+    return bytes(image) + bytes(-len(image) % 4)
+
+def ram_banks(image):
+    image = pad_to_words(image)
+    return [[byte_bits[b] for b in image[lane::4]] for lane in (3, 2, 1, 0)]
+
+def ram_word_listing(image):
+    a, b, c, d = ram_banks(image)
+    return ["_".join(word) for word in zip(a, b, c, d)]
+
+# NDJSON listing - one JSON object per instruction, for tools that would otherwise parse .lmc
+# fields are the fixed position bit fields of the word, whichever format it is
+# operands are as written - registers, then the immediate or the label it refers to
+# an ERROR line has a word and fields of null
+
+def word_fields(word):
+    return {"opcode": get_bits(word, 0, 6),   "rd":  get_bits(word, 7, 11),
+            "funct3": get_bits(word, 12, 14), "rs1": get_bits(word, 15, 19),
+            "rs2":    get_bits(word, 20, 24), "funct7": get_bits(word, 25, 31)}
+
+# ir and result are from build_ir() and encode_pass() - one result entry per ir entry
+def json_records(ir, result):
+    address_to_label = {entry[1]: entry[2] for entry in ir if entry[2]}
+    for (source_line, address, label, cmd, regA, regB, regC, value, jmp_label, comment), entry in zip(ir, result):
+        word = entry[2]
+        if word == None:
+            continue
+        operands = [f"x{reg:d}" for reg in (regA, regB, regC) if reg != None]
+        if value != None:
+            operands.append(value)
+        if jmp_label:
+            operands.append(jmp_label)
+        if word == ERROR:
+            word = None
+        yield {"address": address, "word": word, "fields": word_fields(word) if word != None else None,
+               "mnemonic": cmd, "operands": operands, "source_line": source_line + 1,
+               "label": address_to_label.get(address), "comment": comment}
+
+# "-" writes to stdout - records are written as they are generated
+def write_ndjson(filename, records):
+    f = sys.stdout if filename == "-" else cache.open_new(filename)
+    for record in records:
+        f.write(json.dumps(record) + "\n")
+    if f != sys.stdout:
+        f.close()
+
+# Contents of the .sym sidecar - returns (sections, symbols, lines) for sym.write_sym()
+# ir, label_to_line and data_labels are from build_ir(), data is the data image
+
+def sym_contents(ir, label_to_line, data_labels, data):
+    lines = [(address, source_line + 1) for (source_line, address, label, cmd, *rest) in ir if cmd]
+    text_bytes = lines[-1][0] + 4 if lines else 0
+    symbols = ([(name, "text", address) for name, address in label_to_line.items()] +
+               [(name, "data", address) for name, address in data_labels.items()])
+    return [("text", text_bytes), ("data", len(data))], symbols, lines
+
+# Memory capacity - the sizes are the `define lines in settings.vh
+# instr_bytes is the number of 32 bit words in instruction memory, as the pc is
+# word aligned before it indexes the array - data_bytes is data memory in bytes
+# Both memories wrap silently, so an image too big for them has to be caught here
+
+_DEFINE_RE = re.compile(r"^[ \t]*`define[ \t]+(\w+)[ \t]+(\d+)", re.MULTILINE)
+
+def read_settings(filename):
+    f = open(filename, mode='r')
+    txt = f.read()
+    f.close()
+    return {name: int(value) for name, value in _DEFINE_RE.findall(txt)}
+
+# returns (instruction words, data bytes) used by an assemble() result and its data image
+def image_usage(result, data):
+    return sum(1 for entry in result if entry[2] != None), len(data)
+
+# returns (report lines, True if both images fit) - a size of None is not checked
+def capacity_report(instr_used, instr_size, data_used, data_size):
+    lines = []
+    fits = True
+    for name, used, size, unit in (("instruction memory", instr_used, instr_size, "words"),
+                                   ("data memory", data_used, data_size, "bytes")):
+        if size == None:
+            continue
+        percent = 100 * used / size if size else 100.0
+        line = f"{name:18s} {used:6d} of {size:6d} {unit:5s} {percent:5.1f}%"
+        if used > size:
+            line += f"  ERROR overflows by {used - size:d} {unit:s}"
+            fits = False
+        lines.append(line)
+    return lines, fits
+
+# Smallest size that holds used - a power of two as the address width is $clog2 of
+# the size, and at least one word so each data bank has an entry
+def memory_size(used):
+    size = 4
+    while size < used:
+        size <<= 1
+    return size
+
+def settings_fragment(instr_used, data_used):
+    return ["// Select the size (in bytes) of data memory and instruction memory",
+            f"`define data_bytes       {memory_size(data_used):d}",
+            f"`define instr_bytes      {memory_size(instr_used):d}"]
+
+# Write .mc and .lmc straight from assemble_stream()
+# f1 and f2 must be opened in binary mode so they can be seeked back into
+# The .mc layout is a fixed width for each opcode, so a forward reference is
+# written with a placeholder and overwritten in place once the whole source is read
+# Memory use is the label table plus the fixup table - not the source or the result
+# A forward reference to a label that is never defined is overwritten with ERROR
+# returns (instructions, [undefined labels in the order they are referred to])
+
+def assemble_to_files(lines, f1, f2):
+    label_to_line = {}
+    fixups = []
+    undefined = []
+    pos1 = 0
+    pos2 = 0
+    instructions = 0
+
+    for line_no, label, word, comment, fixup in assemble_stream(lines, label_to_line):
+        out1 = ""
+        out2 = ""
+        if label:
+            s = f"// [{label:s}:{line_no:d}]\n"
+            out1 += s
+            out2 += s
+
+        if comment and word == None:
+            s = f"       {comment:s}\n"
+            out1 += s
+            out2 += s
+
+        if word != None:
+            code = format_mc(word)
+            prefix1 = "        "
+            prefix2 = f"{line_no:<4d}    "
+            if fixup:
+                # the code starts after the label and comment lines and the line prefix
+                fixups.append((pos1 + len(out1.encode()) + len(prefix1),
+                               pos2 + len(out2.encode()) + len(prefix2),
+                               line_no, fixup, len(code)))
+            out1 += f"{prefix1}{code:22s} {comment:s}\n"
+            out2 += f"{prefix2}{code:22s} {comment:s}\n"
+            instructions += 1
+
+        b1 = out1.encode()
+        b2 = out2.encode()
+        f1.write(b1)
+        f2.write(b2)
+        pos1 += len(b1)
+        pos2 += len(b2)
+
+    # Backpatch the forward references
+    for offset1, offset2, line_no, fixup, width in fixups:
+        if fixup[4] in label_to_line:
+            code = format_mc(resolve_fixup(line_no, fixup, label_to_line))
+        else:
+            if fixup[4] not in undefined:
+                undefined.append(fixup[4])
+            code = format_mc(ERROR)
+        code = f"{code:{width}s}".encode()
+        f1.seek(offset1)
+        f1.write(code)
+        f2.seek(offset2)
+        f2.write(code)
+
+    return instructions, undefined
 
 ##############################################################
 
+# Command line
+# python ass.py {source file} - assemble to the screen and to .mc and .lmc files
+
+def write_lines(filename, lines):
+    f = cache.open_new(filename)
+    f.write("\n".join(lines))
+    if lines:
+        f.write("\n")
+    f.close()
+
+def write_screen(lines):
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
+
+# Write each (filename, lines) with one write per file
+# several files are written at the same time from threads as the writes release the GIL
+
+def write_files(outputs):
+    if len(outputs) < 2:
+        for filename, lines in outputs:
+            write_lines(filename, lines)
+        return
+    with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+        for done in [executor.submit(write_lines, filename, lines) for filename, lines in outputs]:
+            done.result()
+
+# Re-assemble each time the source is saved, only encoding the lines the edit affects
+# runs until interrupted
+
+def watch(filename, outname1, outname2, interval=0.2):
+    state = None
+    mtime = None
+    while True:
+        new_mtime = os.stat(filename).st_mtime_ns
+        if new_mtime != mtime:
+            mtime = new_mtime
+            f = open(filename, mode='r')
+            code_clean = [line.strip() for line in f]
+            f.close()
+            try:
+                fmc, state = assemble_incremental(code_clean, state)
+            except KeyError as e:
+                print(f"unknown label {e}")
+            except (TypeError, ValueError) as e:
+                print(f"ERROR {e}")
+            else:
+                mc, lmc = mc_listing(fmc)
+                write_lines(outname1, mc)
+                write_lines(outname2, lmc)
+                print(f"{state['encoded']:d} lines encoded, {outname1:s} and {outname2:s} written")
+        time.sleep(interval)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Assemble a RISC V source file into .mc and .lmc files")
+    parser.add_argument("filename", nargs="?", help="source file, risc_test.rscin to the screen only if missing")
+    parser.add_argument("--format", choices=["mc", "hex", "bin", "ihex", "rso"], default="mc",
+                        help="mc: .mc and .lmc binary text, hex: $readmemh .hex, bin: raw little endian .bin, ihex: Intel HEX .ihex, "
+                             "rso: relocatable object for link.py")
+    parser.add_argument("--stream", action="store_true",
+                        help="stream the source straight to the output files, for very large sources - code only, no directives")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes for the encoding pass")
+    parser.add_argument("--watch", action="store_true",
+                        help="re-assemble incrementally every time the source changes - code only, no directives")
+    parser.add_argument("--cache", metavar="DIR", help="build cache directory - an unchanged source reuses its outputs")
+    parser.add_argument("--cache-size", type=int, default=256, metavar="MB", help="build cache size limit")
+    parser.add_argument("--link", action="store_true", help="hard link outputs from the build cache instead of copying - do not edit them in place")
+    parser.add_argument("--ram", action="store_true",
+                        help="write the .data section to the four data memory bank files {source}_ramA.mem to _ramD.mem")
+    parser.add_argument("--ram-word", action="store_true",
+                        help="write the .data section to the word wide data memory file {source}_mem_word.mem")
+    parser.add_argument("--settings", metavar="FILE",
+                        help="check the program fits the data_bytes and instr_bytes in this settings.vh")
+    parser.add_argument("--instr-bytes", type=int, metavar="N", help="instruction memory size to check against, overrides --settings")
+    parser.add_argument("--data-bytes", type=int, metavar="N", help="data memory size to check against, overrides --settings")
+    parser.add_argument("--write-settings", metavar="FILE",
+                        help="write a settings.vh fragment with memory sizes for this program - not used with --cache")
+    parser.add_argument("--quiet", action="store_true", help="do not echo the source and listing to the screen")
+    parser.add_argument("--sym", action="store_true",
+                        help="write the symbol table and pc to source line map to a binary .sym file")
+    parser.add_argument("--ndjson", metavar="FILE",
+                        help="also write one JSON object per instruction to FILE, - for stdout - not used with --cache")
+    args = parser.parse_args(argv)
+
+    # memory sizes to check the images against
+    instr_size = args.instr_bytes
+    data_size = args.data_bytes
+    if args.settings:
+        settings = read_settings(args.settings)
+        if instr_size == None:
+            instr_size = settings.get("instr_bytes")
+        if data_size == None:
+            data_size = settings.get("data_bytes")
+    check_sizes = instr_size != None or data_size != None
+
+    ram_names = []
+    if args.filename:
+        filename = args.filename
+        basename = os.path.splitext(filename)[0]
+        outname1 = basename + ".mc"
+        outname2 = basename + ".lmc"
+        if args.format != "mc":
+            outname1 = basename + "." + args.format
+            outname2 = None
+        if args.ram:
+            ram_names = [basename + "_ram" + bank + ".mem" for bank in "ABCD"]
+        if args.ram_word:
+            ram_names.append(basename + "_mem_word.mem")
+        sym_name = basename + ".sym" if args.sym else None
+    else:
+        filename = "risc_test.rscin"
+        outname1 = None
+        outname2 = None
+        sym_name = None
+
+    if (ram_names or check_sizes or args.write_settings or args.ndjson or args.sym) and (args.watch or args.stream):
+        parser.error("--ram, --ram-word, --ndjson, --sym and the memory size options cannot be used with --watch or --stream")
+
+    if args.watch:
+        if not outname1:
+            parser.error("--watch needs a source file")
+        if args.format != "mc":
+            parser.error("--watch only writes .mc and .lmc")
+        try:
+            watch(filename, outname1, outname2)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    # build cache - keyed on the source contents, only when writing files
+    key = None
+    outnames = [name for name in (outname1, outname2, sym_name) if name] + ram_names
+    if args.cache and outname1 and not args.write_settings and not args.ndjson:
+        f = open(filename, mode='rb')
+        source = f.read()
+        f.close()
+        # a source with includes depends on other files so is never cached
+        if b".include" not in source.lower():
+            key = cache.cache_key(source, "ass", VERSION, __file__,
+                                  f"{args.format:s} ram={args.ram:d} ram_word={args.ram_word:d} sym={args.sym:d} "
+                                  f"instr_bytes={instr_size} data_bytes={data_size}")
+        if key and cache.cache_fetch(args.cache, key, outnames, args.link):
+            print(" and ".join(outnames) + " from cache")
+            return
+
+    # streaming - read the source a line at a time and write the files as we go
+    if args.stream:
+        if not outname1:
+            parser.error("--stream needs a source file")
+        if args.format != "mc":
+            parser.error("--stream only writes .mc and .lmc")
+        f = open(filename, mode='r')
+        f1 = cache.open_new(outname1, mode='wb')
+        f2 = cache.open_new(outname2, mode='wb')
+        try:
+            count, undefined = assemble_to_files(f, f1, f2)
+        except ValueError as e:
+            # do not leave half written files behind
+            for out in (f1, f2):
+                out.close()
+                os.remove(out.name)
+            print(f"ERROR {e}")
+            sys.exit(1)
+        f.close()
+        f1.close()
+        f2.close()
+        print(f"{count:d} instructions written to {outname1:s} and {outname2:s}")
+        if undefined:
+            print("ERROR undefined label " + ", ".join(undefined))
+            sys.exit(1)
+        if key:
+            cache.cache_store(args.cache, key, outnames, args.cache_size * 1024 * 1024)
+        return
+
+    # read input file  into code_clean   
+    f = open(filename, mode='r')
+    code = f.readlines()
+    f.close()
+    code_clean =[line.strip() for line in code]
+
+    # assemble
+    data = bytearray()
+    try:
+        ir, label_to_line, data_labels = build_ir(code_clean, data, filename)
+    except ValueError as e:
+        print(f"ERROR {e}")
+        sys.exit(1)
+    if args.format == "rso":
+        obj = object_from_ir(ir, label_to_line, data_labels, data)
+        fmc = [tuple(entry) for entry in obj["result"]]
+    else:
+        fmc = encode_pass(ir, label_to_line, data_labels, args.workers)
+
+    # Check the images fit before anything is written - memory wraps without warning
+    instr_used, data_used = image_usage(fmc, data)
+    if check_sizes:
+        report, fits = capacity_report(instr_used, instr_size, data_used, data_size)
+        for line in report:
+            print(line)
+        if not fits:
+            sys.exit(1)
+    if args.write_settings:
+        write_lines(args.write_settings, settings_fragment(instr_used, data_used))
+
+    # Other formats - one file written from the instruction words
+    outputs = []
+    if args.format == "hex":
+        outputs.append((outname1, readmemh_listing(fmc)))
+    elif args.format == "ihex":
+        outputs.append((outname1, intel_hex(machine_words(fmc))))
+    elif args.format == "rso":
+        outputs.append((outname1, [json.dumps(obj)]))
+    elif args.format == "bin":
+        f = cache.open_new(outname1, mode='wb')
+        f.write(binary_image(machine_words(fmc)))
+        f.close()
+
+    if args.ndjson:
+        write_ndjson(args.ndjson, json_records(ir, fmc))
+
+    if sym_name:
+        sym.write_sym(sym_name, *sym_contents(ir, label_to_line, data_labels, data))
+
+    # Data memory - four byte banks and / or one word wide file
+    if args.ram:
+        outputs += zip(ram_names, ram_banks(data))
+    if args.ram_word:
+        outputs.append((ram_names[-1], ram_word_listing(data)))
+
+    # Machine code to two files, one with line numbers, one without
+    mc, lmc = mc_listing(fmc)
+    if args.format == "mc" and outname1:
+        outputs += [(outname1, mc), (outname2, lmc)]
+    write_files(outputs)
+
+    # Print out the source and the listing in one write each
+    if not args.quiet:
+        write_screen(code_clean + [""])
+        write_screen(lmc)
+
+    if key:
+        cache.cache_store(args.cache, key, outnames, args.cache_size * 1024 * 1024)
+
 
-import sys, os
-filename = ""
-
-if len(sys.argv) == 2:
-    filename = sys.argv[1]
-    splitname = re.split("\.", filename)
-    outname1 = splitname[0] + ".mc"
-    outname2 = splitname[0] + ".lmc"
-else:
-    filename = "risc_test.rscin"
-    outname1 = None
-    outname2 = None
-
-# read input file  into code_clean   
-f = open(filename, mode='r')
-code = f.readlines()
-f.close()
-code_clean =[line.strip() for line in code]
-
-# assemble
-fmc = assemble(code_clean)
-
-# Print out the result
-for l in code_clean:
-    print(l)
-
-print()
-
-# helper to reduce number of checks on files in the main loop
-def printfile(txt, f):
-    if f != None:
-        print(txt, file = f)
-        
-# Print machine code to two files, one with line numbers, one without
-if outname1:
-    f1 = open(outname1, mode='w')
-    f2 = open(outname2, mode='w')
-else:
-    f1 = None
-    f2 = None
-    
-for line_no, label, code, comment in fmc:
-    if label:
-        s = f"// [{label:s}:{line_no:d}]"
-        print(s)
-        printfile(s, f1)
-        printfile(s, f2)
-
-    if comment and not code:
-        s = f"       {comment:s}"
-        print(s)
-        printfile(s, f1)
-        printfile(s, f2)
-        
-    if code:
-        s1 = f"        {code:22s} {comment:s}"
-        s2 = f"{line_no:<4d}    {code:22s} {comment:s}"
-        print(s2)
-        printfile(s1, f1)
-        printfile(s2, f2)
-
-if outname1:
-    f1.close()
-    f2.close()
+if __name__ == "__main__":
+    main()
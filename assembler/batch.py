@@ -0,0 +1,197 @@
+# Batch assembler and disassembler
+# Processes whole directory trees in one interpreter instead of one python per file
+
+# Each directory is searched recursively, anything else is taken as a glob
+# Files pulled in with .include are tokenised once per worker process, not once per program
+# Source files (.rscin) are assembled to .mc and .lmc
+# With --dis machine code files (.mc) are disassembled to .rsc and .lrs
+
+# Example:
+
+# python batch.py "assembler v0.5" ../assembler --workers 8
+# python batch.py --dis "assembler v0.5/*.mc"
+
+# The files are shared out to a pool of worker processes
+# the instruction tables are built once per worker when ass.py is imported
+
+import os, glob, time, argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from . import ass, dis, cache
+except ImportError:
+    import ass, dis, cache
+
+
+def find_files(paths, extension):
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                found += [os.path.join(root, name) for name in sorted(files) if name.endswith(extension)]
+        else:
+            found += sorted(name for name in glob.glob(path, recursive=True) if name.endswith(extension))
+    return found
+
+def write_lines(filename, lines):
+    f = cache.open_new(filename)
+    f.write("\n".join(lines))
+    if lines:
+        f.write("\n")
+    f.close()
+
+# Look for a file's outputs in the build cache
+# returns (key, result) - result is set on a hit, key is None with no cache
+
+def from_cache(filename, outnames, tool, version, module_file, cache_dir):
+    if not cache_dir:
+        return None, None
+    start = time.perf_counter()
+    f = open(filename, mode='rb')
+    source = f.read()
+    f.close()
+    # a source with includes depends on other files so is never cached
+    if b".include" in source.lower():
+        return None, None
+    key = cache.cache_key(source, tool, version, module_file)
+    if cache.cache_fetch(cache_dir, key, outnames):
+        return key, (filename, len(source.splitlines()), 0, time.perf_counter() - start, 0.0, 0.0, None, True, None)
+    return key, None
+
+# Process one file
+# returns (filename, lines, errors, read time, process time, write time, error message, cache hit,
+#          decode cache (hits, misses, evictions) for a disassembly or None)
+
+def assemble_file(filename, cache_dir=None, cache_bytes=cache.DEFAULT_MAX_BYTES):
+    basename = os.path.splitext(filename)[0]
+    outnames = [basename + ".mc", basename + ".lmc"]
+    key, hit = from_cache(filename, outnames, "ass", ass.VERSION, ass.__file__, cache_dir)
+    if hit:
+        return hit
+
+    start = time.perf_counter()
+    f = open(filename, mode='r')
+    code_clean = [line.strip() for line in f]
+    f.close()
+    read_done = time.perf_counter()
+
+    try:
+        result = ass.assemble(code_clean, filename=filename)
+    except Exception as e:
+        return (filename, len(code_clean), 1, read_done - start, 0.0, 0.0, f"{type(e).__name__}: {e}", False, None)
+    errors = sum(1 for entry in result if entry[2] == ass.ERROR)
+    mc, lmc = ass.mc_listing(result)
+    work_done = time.perf_counter()
+
+    write_lines(outnames[0], mc)
+    write_lines(outnames[1], lmc)
+    if key:
+        cache.cache_store(cache_dir, key, outnames, cache_bytes)
+    write_done = time.perf_counter()
+
+    return (filename, len(code_clean), errors,
+            read_done - start, work_done - read_done, write_done - work_done, None, False, None)
+
+def disassemble_file(filename, cache_dir=None, cache_bytes=cache.DEFAULT_MAX_BYTES):
+    basename = os.path.splitext(filename)[0]
+    outnames = [basename + ".rsc", basename + ".lrs"]
+    key, hit = from_cache(filename, outnames, "dis", dis.VERSION, dis.__file__, cache_dir)
+    if hit:
+        return hit
+
+    start = time.perf_counter()
+    f = open(filename, mode='r')
+    code_clean = [line.strip() for line in f]
+    f.close()
+    read_done = time.perf_counter()
+
+    before = [dis.decode_stats[name] for name in ("hits", "misses", "evictions")]
+    try:
+        full_assembly = dis.disassemble(code_clean)
+    except Exception as e:
+        return (filename, len(code_clean), 1, read_done - start, 0.0, 0.0, f"{type(e).__name__}: {e}", False, None)
+    decoded = tuple(dis.decode_stats[name] - n for name, n in zip(("hits", "misses", "evictions"), before))
+    rsc, lrs = dis.rsc_listing(full_assembly)
+    work_done = time.perf_counter()
+
+    write_lines(outnames[0], rsc)
+    write_lines(outnames[1], lrs)
+    if key:
+        cache.cache_store(cache_dir, key, outnames, cache_bytes)
+    write_done = time.perf_counter()
+
+    return (filename, len(code_clean), 0,
+            read_done - start, work_done - read_done, write_done - work_done, None, False, decoded)
+
+# Run every file through process_file, in worker processes if workers > 1
+# returns the per file results in the same order as filenames
+
+def run_batch(filenames, process_file, workers=None):
+    if workers == 1:
+        return [process_file(filename) for filename in filenames]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(filenames) // ((workers or os.cpu_count() or 1) * 8))
+        return list(executor.map(process_file, filenames, chunksize=chunksize))
+
+def summary(results, wall_time):
+    lines = sum(r[1] for r in results)
+    errors = sum(r[2] for r in results)
+    read_time = sum(r[3] for r in results)
+    work_time = sum(r[4] for r in results)
+    write_time = sum(r[5] for r in results)
+    hits = sum(1 for r in results if r[7])
+
+    out = []
+    for filename, count, file_errors, t_read, t_work, t_write, message, cached, decoded in results:
+        if message:
+            out.append(f"ERROR  {filename:s}: {message:s}")
+        elif file_errors:
+            out.append(f"ERROR  {filename:s}: {file_errors:d} lines could not be assembled")
+    out.append(f"files   {len(results):10d}")
+    out.append(f"lines   {lines:10d}")
+    out.append(f"errors  {errors:10d}")
+    out.append(f"cached  {hits:10d}")
+    decoded = [r[8] for r in results if r[8]]
+    if decoded:
+        # each worker process has its own decode cache
+        out.append(f"decode cache hits {sum(d[0] for d in decoded):10d}  misses {sum(d[1] for d in decoded):10d}  "
+                   f"evictions {sum(d[2] for d in decoded):10d}")
+    out.append(f"read    {read_time:10.3f} s")
+    out.append(f"process {work_time:10.3f} s")
+    out.append(f"write   {write_time:10.3f} s")
+    out.append(f"wall    {wall_time:10.3f} s")
+    return out
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Assemble or disassemble many files in one process")
+    parser.add_argument("paths", nargs="+", help="directories (searched recursively) or globs")
+    parser.add_argument("--dis", action="store_true", help="disassemble .mc files instead of assembling .rscin files")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes, default is one per cpu")
+    parser.add_argument("--cache", metavar="DIR", help="build cache directory - unchanged files reuse their outputs")
+    parser.add_argument("--cache-size", type=int, default=256, metavar="MB", help="build cache size limit")
+    args = parser.parse_args(argv)
+
+    if args.dis:
+        filenames = find_files(args.paths, ".mc")
+        process_file = disassemble_file
+    else:
+        filenames = find_files(args.paths, ".rscin")
+        process_file = assemble_file
+
+    if args.cache:
+        process_file = partial(process_file, cache_dir=args.cache, cache_bytes=args.cache_size * 1024 * 1024)
+
+    start = time.perf_counter()
+    results = run_batch(filenames, process_file, args.workers)
+    if args.cache and os.path.isdir(args.cache):
+        # the workers' running totals can miss each other's stores, so trim exactly once at the end
+        cache.evict(args.cache, args.cache_size * 1024 * 1024)
+    for line in summary(results, time.perf_counter() - start):
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
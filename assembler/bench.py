@@ -0,0 +1,96 @@
+# Micro-benchmark for the assembler lexer
+
+# Times tokenise() against the previous string-rewrite tokeniser over
+# every .rscin file in the repository and prints lines per second
+
+# Usage:
+# python bench.py {repeat}
+
+import glob, os, re, sys, time
+
+from ass import tokenise
+
+
+# The tokeniser as it was before the single regex lexer - kept only for comparison
+
+def legacy_is_int(s):
+    return s.isnumeric() or (s[0] == "-" and s[1:].isnumeric())
+
+def legacy_tokenise(txt) :
+    txt = txt.replace("[", " ")
+    txt = txt.replace("]","")
+    txt = txt.replace("(", " ")
+    txt = txt.replace(")","")
+    txt = txt.replace("+", " ")
+    txt = txt.lower()
+
+    l_brace = txt.find("{")
+    r_brace = txt.find("}")
+    if r_brace > -1 and l_brace > -1:
+        txt = txt[ : l_brace] + txt [r_brace + 1: ]
+
+    comment = ""
+    comment_location = txt.find("//")
+    if comment_location != -1:
+        comment = txt[comment_location : ]
+        txt = txt[ : comment_location].strip()
+
+    sp = re.split("[,\\s]+", txt)
+
+    label = None
+    cmd   = None
+    regA  = None
+    regB  = None
+    regC  = None
+    value = None
+    jmp_label = None
+
+    for ind, c in enumerate(sp):
+        if len(c) > 0:
+            if ind == 0 and legacy_is_int(c):
+                pass
+            elif c[-1] == ":":
+                label = c[:-1]
+            elif cmd == None:
+                cmd = c
+            elif regA == None and c[0] == "x" and c[1:].isnumeric():
+                regA = int(c[1])
+            elif regB == None and c[0] == "x" and c[1:].isnumeric():
+                regB = int(c[1])
+            elif regC == None and c[0] == "x" and c[1:].isnumeric():
+                regC = int(c[1])
+            elif value == None  and legacy_is_int(c):
+                value = int(c)
+            else:
+                jmp_label = c
+
+    return label, cmd, regA, regB, regC, value, jmp_label, comment
+
+
+def load_corpus():
+    here = os.path.dirname(os.path.abspath(__file__))
+    pattern = os.path.join(here, "..", "assembler*", "*.rscin")
+    lines = []
+    for filename in sorted(glob.glob(pattern)):
+        with open(filename, mode='r') as f:
+            lines += [line.strip() for line in f]
+    return lines
+
+def lines_per_second(fn, lines):
+    start = time.perf_counter()
+    for line in lines:
+        fn(line)
+    return len(lines) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    corpus = load_corpus()
+    lines = corpus * repeat
+    print(f"{len(corpus):d} lines in corpus, {len(lines):d} lines timed")
+
+    before = lines_per_second(legacy_tokenise, lines)
+    after  = lines_per_second(tokenise, lines)
+    print(f"before  {before:12,.0f} lines/s")
+    print(f"after   {after:12,.0f} lines/s")
+    print(f"speedup {after / before:12.2f}x")
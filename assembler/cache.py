@@ -0,0 +1,163 @@
+# Build cache for the assembler and disassembler outputs
+
+# An entry is keyed on a hash of the source file contents, the tool, its version
+# and source code, and any options that change the output
+# so an unchanged source is never assembled twice
+
+# Layout:
+# {cache_dir}/{key[:2]}/{key}/mc
+#                             lmc
+# one file per output, named by what follows the part of the name the outputs share
+# so test.mc and test_ramA.mem are stored as .mc and _ramA.mem
+
+# Entries are evicted least recently used first once the cache is bigger than max_bytes
+# a hit touches the entry so it counts as recently used
+# A running total of the bytes stored is kept in {cache_dir}/size so a store does not
+# walk the cache - evict() only walks it once the total passes max_bytes, and writes
+# back the exact total. Stores running at the same time can each miss the other's
+# update so the total can run low, but the next evict() puts it right
+# A store that passes max_bytes evicts down to 90% of it, so a full cache is walked
+# once per tenth of its size stored rather than on every store
+
+# An output fetched with link=True is the cache's own file under another name, so
+# every tool writes its outputs with open_new(), which removes the old name first
+# and never writes through a link into the cache
+
+import os, shutil, hashlib, tempfile
+
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# hash of a tool's own source so editing the assembler invalidates its entries
+tool_hashes = {}
+
+def tool_hash(module_file):
+    if module_file not in tool_hashes:
+        f = open(module_file, mode='rb')
+        tool_hashes[module_file] = hashlib.sha256(f.read()).hexdigest()
+        f.close()
+    return tool_hashes[module_file]
+
+def cache_key(source, tool, version, module_file, options=""):
+    h = hashlib.sha256()
+    for part in (tool, version, tool_hash(module_file), options):
+        h.update(part.encode())
+        h.update(b"\0")
+    h.update(source)
+    return h.hexdigest()
+
+# Open filename for writing as a new file - an existing file or link of that name is removed
+def open_new(filename, mode='w'):
+    if os.path.lexists(filename):
+        os.remove(filename)
+    return open(filename, mode=mode)
+
+SIZE_FILE = "size"
+
+# None if there is no total yet
+def read_total(cache_dir):
+    try:
+        f = open(os.path.join(cache_dir, SIZE_FILE), mode='r')
+        total = int(f.read())
+        f.close()
+        return total
+    except (OSError, ValueError):
+        return None
+
+# written under a temporary name and renamed so a reader never sees half a number
+def write_total(cache_dir, total):
+    fd, temp = tempfile.mkstemp(dir=cache_dir)
+    f = os.fdopen(fd, mode='w')
+    f.write(str(total))
+    f.close()
+    os.replace(temp, os.path.join(cache_dir, SIZE_FILE))
+
+def entry_dir(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key)
+
+def entry_names(outnames):
+    if len(outnames) == 1:
+        return [os.path.splitext(outnames[0])[1][1:]]
+    stem = os.path.commonprefix(outnames)
+    return [outname[len(stem):] for outname in outnames]
+
+# Copy (or hard link) a cached entry to outnames
+# a hard linked output shares its contents with the cache so must not be edited in place
+# returns True on a hit, False if there is no entry
+
+def cache_fetch(cache_dir, key, outnames, link=False):
+    entry = entry_dir(cache_dir, key)
+    if not os.path.isdir(entry):
+        return False
+    cached_names = [os.path.join(entry, name) for name in entry_names(outnames)]
+    for cached in cached_names:
+        if not os.path.isfile(cached):
+            return False
+
+    for outname, cached in zip(outnames, cached_names):
+        # never write through a link into the cache - replace the name instead
+        # (copying onto a link of the cached file would also be copying a file onto itself)
+        if os.path.lexists(outname):
+            os.remove(outname)
+        if link:
+            try:
+                os.link(cached, outname)
+                continue
+            except OSError:
+                pass
+        shutil.copyfile(cached, outname)
+
+    os.utime(entry)
+    return True
+
+# Copy outnames into the cache under key, then evict down to max_bytes if the
+# running total has passed it
+
+def cache_store(cache_dir, key, outnames, max_bytes=DEFAULT_MAX_BYTES):
+    entry = entry_dir(cache_dir, key)
+    parent = os.path.dirname(entry)
+    os.makedirs(parent, exist_ok=True)
+
+    # build the entry under a temporary name and rename it so a half written
+    # entry is never seen by another process
+    temp = tempfile.mkdtemp(dir=parent)
+    size = 0
+    for outname, name in zip(outnames, entry_names(outnames)):
+        shutil.copyfile(outname, os.path.join(temp, name))
+        size += os.path.getsize(outname)
+    try:
+        os.rename(temp, entry)
+    except OSError:
+        # another process stored the same entry first
+        shutil.rmtree(temp, ignore_errors=True)
+        return
+
+    total = read_total(cache_dir)
+    if total == None or total + size > max_bytes:
+        evict(cache_dir, max_bytes * 9 // 10)
+    else:
+        write_total(cache_dir, total + size)
+
+def evict(cache_dir, max_bytes):
+    entries = []
+    total = 0
+    for prefix in os.listdir(cache_dir):
+        prefix_dir = os.path.join(cache_dir, prefix)
+        if not os.path.isdir(prefix_dir):
+            continue
+        for key in os.listdir(prefix_dir):
+            entry = os.path.join(prefix_dir, key)
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                continue
+            total += size
+
+    entries.sort()
+    for mtime, size, entry in entries:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+    write_total(cache_dir, total)
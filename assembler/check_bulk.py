@@ -0,0 +1,71 @@
+# Equivalence check for the NumPy bulk decoder
+
+# disassemble_word() is the reference - bulk_disassemble() must give the same text
+# for every word, and disassemble_bulk() the same listing as disassemble()
+# Checks random words, random words with a real opcode so every format is covered,
+# and every 32 bit word in the .mc files in the repository
+# Prints the first few differences and exits with status 1 if there are any
+
+# Usage:
+# python check_bulk.py {random words}
+
+import glob, os, random, sys
+
+from dis import disassemble_word, bulk_disassemble, disassemble, disassemble_bulk, split_line
+
+
+opcodes = [0b00000_11, 0b01000_11, 0b01100_11, 0b00100_11, 0b11000_11,
+           0b11001_11, 0b11011_11, 0b01101_11, 0b00101_11]
+
+def random_words(count, seed=1):
+    rng = random.Random(seed)
+    words = [rng.getrandbits(32) for i in range(count // 2)]
+    words += [(rng.getrandbits(25) << 7) | rng.choice(opcodes) for i in range(count - count // 2)]
+    # the extremes of every field
+    words += [0, 0xffffffff] + [opcode | 0xffffff80 for opcode in opcodes]
+    return words
+
+# .mc files whose lines are all 32 bit words - the older versions are 16 bit
+def load_reference():
+    here = os.path.dirname(os.path.abspath(__file__))
+    pattern = os.path.join(here, "..", "assembler*", "*.mc")
+    files = []
+    for filename in sorted(glob.glob(pattern)):
+        with open(filename, mode='r') as f:
+            code = [line.strip() for line in f]
+        words = []
+        for line in code:
+            line, comment, comment_location = split_line(line)
+            if comment_location != 0 and line != "":
+                words.append(line.replace("_", "").strip())
+        if words and all(len(word) == 32 and set(word) <= {"0", "1"} for word in words):
+            files.append((os.path.relpath(filename, os.path.join(here, "..")), code, [int(word, 2) for word in words]))
+    return files
+
+def differences(words):
+    return [(word, expected, got) for word, expected, got
+            in zip(words, [disassemble_word(word) for word in words], bulk_disassemble(words))
+            if expected != got]
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    failed = False
+
+    words = random_words(count)
+    wrong = differences(words)
+    print(f"random      {len(words):8d} words  {len(wrong):d} different")
+    for word, expected, got in wrong[:10]:
+        print(f"  {word:08x}  {expected!r}  bulk {got!r}")
+    failed |= bool(wrong)
+
+    for filename, code, words in load_reference():
+        wrong = differences(words)
+        same = disassemble_bulk(code) == disassemble(code)
+        print(f"{filename:40s} {len(words):6d} words  {len(wrong):d} different"
+              + ("" if same else "  listing differs"))
+        for word, expected, got in wrong[:10]:
+            print(f"  {word:08x}  {expected!r}  bulk {got!r}")
+        failed |= bool(wrong) or not same
+
+    sys.exit(1 if failed else 0)
@@ -31,6 +31,13 @@
 # 12      000000_0_00001_00011_000_00010_00010_11
 # 12       0000000_00010_00001_000_00000_00001_11  // with comment
 
+# The output of ass.py --format hex ($readmemh) and --format bin (raw little endian words)
+# is read too - chosen by the .hex or .bin extension, or with --input
+# A binary file has no labels or comments so its listing has none
+
+# With --cfg every branch and jal target is given a label so the .rsc can be assembled
+# again, and the basic blocks are written to a .blk file
+
 # Instruction formats
 
 # lw     rd,  imm(rs1)
@@ -71,6 +78,18 @@
 # lui      ----------imm-------  --rgA 01101 11
 # auipc    ----------imm-------  --rgA 00101 11
 
+import re, os, sys, json, mmap, argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from . import cache, sym
+except ImportError:
+    import cache, sym
+
+VERSION = "0.6"
+
+
 def is_int(s):
     return s.isnumeric() or (s[0] == "-" and s[1:].isnumeric())
 
@@ -93,14 +112,10 @@ def sign_extend(value, bits):
     else:
         return 0
     
-def disassemble(code):
-    full_assembly = []
-    opcodes_old = ["ld ", "st ", "add", "sub", "inv", "lsl", "lsr", "and", "or ", "slt", "", "beq", "bne", "jmp", "lui", "lli"]
+# Label table from the // [label:address] comments - address: label
 
-    line_number = 0
+def find_labels(code):
     label_names = {}
-
-    # Pass 1 - add all labels to the label table
     for line in code:
         find_label = line.find("// [")
         find_colon = line.find(":")
@@ -110,25 +125,202 @@ def disassemble(code):
             value = line[find_colon + 1: find_end]
             if is_int(value):
                 label_names[int(value)] = label
+    return label_names
+
+# Split a line into (binary, comment, comment location)
+# anything between braces {} is removed
+
+def split_line(line):
+    comment = ""
+    brace_start = line.find("{")
+    brace_end  = line.find("}")
+    if brace_start > -1 and brace_end > -1:
+        line = line[:brace_start] + line[brace_end + 1:]
+
+    # split on comment //
+    line = line.strip()        
+    comment_location = line.find("//")
+    if comment_location > -1:
+        comment = line[comment_location :]
+        line = line[:comment_location]
+    return line, comment, comment_location
+
+# Decoder - one table lookup on the opcode, funct3 and funct7 bits of a word
+# finds the mnemonic and the formatter for its format, and the formatter
+# extracts only the fields and the one immediate that format has
+
+# Immediates, sign extended - the bits are gathered from the word per the spec
+
+def imm_I(value):
+    return ((value >> 20) ^ 0x800) - 0x800
+
+def imm_S(value):
+    return ((((value >> 20) & 0xfe0) | ((value >> 7) & 0x1f)) ^ 0x800) - 0x800
+
+def imm_B(value):
+    #        imm[12]                     imm[11]                    imm[10:5]                   imm[4:1]
+    imm = ((value >> 19) & 0x1000) | ((value << 4) & 0x800) | ((value >> 20) & 0x7e0) | ((value >> 7) & 0x1e)
+    return (imm ^ 0x1000) - 0x1000
+
+def imm_U(value):
+    return ((value >> 12) ^ 0x80000) - 0x80000
+
+def imm_J(value):
+    #        imm[20]                       imm[19:12]             imm[11]                    imm[10:1]
+    imm = ((value >> 11) & 0x100000) | (value & 0xff000) | ((value >> 9) & 0x800) | ((value >> 20) & 0x7fe)
+    return (imm ^ 0x100000) - 0x100000
+
+# Operands as written for each format
+
+def operands_R(value):
+    return f"x{(value >> 7) & 31:d}, x{(value >> 15) & 31:d}, x{(value >> 20) & 31:d}"
+
+def operands_I(value):
+    return f"x{(value >> 7) & 31:d}, x{(value >> 15) & 31:d}, {imm_I(value):d}"
+
+def operands_Ishift(value):
+    return f"x{(value >> 7) & 31:d}, x{(value >> 15) & 31:d}, {(value >> 20) & 31:d}"
+
+def operands_load(value):
+    return f"x{(value >> 7) & 31:d}, {imm_I(value):d}(x{(value >> 15) & 31:d})"
+
+def operands_S(value):
+    return f"x{(value >> 20) & 31:d}, {imm_S(value):d}(x{(value >> 15) & 31:d})"
+
+def operands_B(value):
+    return f"x{(value >> 15) & 31:d}, x{(value >> 20) & 31:d}, {imm_B(value):d}"
+
+def operands_J(value):
+    return f"x{(value >> 7) & 31:d}, {imm_J(value):d}"
+
+def operands_U(value):
+    return f"x{(value >> 7) & 31:d}, {imm_U(value):d}"
+
+# mnemonic: (opcode, funct3, funct7, operands) - None matches any value of that field
+
+decode_specs = {
+    "lb":    (0b00000_11, 0, None, operands_load),
+    "lh":    (0b00000_11, 1, None, operands_load),
+    "lw":    (0b00000_11, 2, None, operands_load),
+    "lbu":   (0b00000_11, 4, None, operands_load),
+    "lhu":   (0b00000_11, 5, None, operands_load),
+
+    "sb":    (0b01000_11, 0, None, operands_S),
+    "sh":    (0b01000_11, 1, None, operands_S),
+    "sw":    (0b01000_11, 2, None, operands_S),
+
+    "add":   (0b01100_11, 0, 0b0000000, operands_R),
+    "sub":   (0b01100_11, 0, 0b0100000, operands_R),
+    "sll":   (0b01100_11, 1, 0b0000000, operands_R),
+    "slt":   (0b01100_11, 2, 0b0000000, operands_R),
+    "sltu":  (0b01100_11, 3, 0b0000000, operands_R),
+    "xor":   (0b01100_11, 4, 0b0000000, operands_R),
+    "srl":   (0b01100_11, 5, 0b0000000, operands_R),
+    "sra":   (0b01100_11, 5, 0b0100000, operands_R),
+    "or":    (0b01100_11, 6, 0b0000000, operands_R),
+    "and":   (0b01100_11, 7, 0b0000000, operands_R),
+
+    "addi":  (0b00100_11, 0, None, operands_I),
+    "slti":  (0b00100_11, 2, None, operands_I),
+    "sltiu": (0b00100_11, 3, None, operands_I),
+    "xori":  (0b00100_11, 4, None, operands_I),
+    "ori":   (0b00100_11, 6, None, operands_I),
+    "andi":  (0b00100_11, 7, None, operands_I),
+
+    "slli":  (0b00100_11, 1, 0b0000000, operands_Ishift),
+    "srli":  (0b00100_11, 5, 0b0000000, operands_Ishift),
+    "srai":  (0b00100_11, 5, 0b0100000, operands_Ishift),
+
+    "beq":   (0b11000_11, 0, None, operands_B),
+    "bne":   (0b11000_11, 1, None, operands_B),
+    "blt":   (0b11000_11, 4, None, operands_B),
+    "bge":   (0b11000_11, 5, None, operands_B),
+    "bltu":  (0b11000_11, 6, None, operands_B),
+    "bgeu":  (0b11000_11, 7, None, operands_B),
+
+    # the control unit decodes jalr on its opcode alone, so any funct3 is shown as jalr
+    "jalr":  (0b11001_11, None, None, operands_load),
+    "jal":   (0b11011_11, None, None, operands_J),
+    "lui":   (0b01101_11, None, None, operands_U),
+    "auipc": (0b00101_11, None, None, operands_U),
+}
+
+# the bits of a word the table is indexed on - funct7, funct3 and opcode
+DECODE_MASK = 0xfe00707f
+
+# (word & DECODE_MASK): (mnemonic and tab, operands) - every funct3 and funct7 a spec
+# matches is entered, so a lookup never needs a second try
+def build_decode_table():
+    table = {}
+    for mnemonic, (opcode, funct3, funct7, operands) in decode_specs.items():
+        for f3 in ([funct3] if funct3 != None else range(8)):
+            for f7 in ([funct7] if funct7 != None else range(128)):
+                table[(f7 << 25) | (f3 << 12) | opcode] = (mnemonic + "\t", operands)
+    return table
+
+decode_table = build_decode_table()
+
+# The assembly for one 32 bit word - mnemonic, a tab, then the operands
+# a word that is not an RV32I instruction gives ""
+
+def disassemble_word(value):
+    entry = decode_table.get(value & DECODE_MASK)
+    if entry == None:
+        return ""
+    mnemonic, operands = entry
+    return mnemonic + operands(value)
+
+# Decode cache - programs and traces repeat the same words over and over (loop bodies,
+# nops, jal spins) so the padded assembly for each word is kept in a bounded least
+# recently used cache, and a word is only decoded the first time it is seen
+# decode_stats counts the hits, misses and evictions
+
+decode_cache = OrderedDict()
+decode_cache_size = 65536
+decode_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+# 0 turns the cache off
+def set_decode_cache_size(size):
+    global decode_cache_size
+    decode_cache_size = size
+    while len(decode_cache) > size:
+        decode_cache.popitem(last=False)
+        decode_stats["evictions"] += 1
+
+def assembly_text(value):
+    text = decode_cache.get(value)
+    if text != None:
+        decode_cache.move_to_end(value)
+        decode_stats["hits"] += 1
+        return text
+    decode_stats["misses"] += 1
+    text = f"{disassemble_word(value):25s}"
+    if decode_cache_size > 0:
+        decode_cache[value] = text
+        if len(decode_cache) > decode_cache_size:
+            decode_cache.popitem(last=False)
+            decode_stats["evictions"] += 1
+    return text
+
+def decode_cache_report():
+    lookups = decode_stats["hits"] + decode_stats["misses"]
+    rate = 100 * decode_stats["hits"] / lookups if lookups else 0.0
+    return [f"decode cache  {decode_stats['hits']:d} hits  {decode_stats['misses']:d} misses  "
+            f"{decode_stats['evictions']:d} evictions  {rate:.1f}% hit rate  "
+            f"{len(decode_cache):d} of {decode_cache_size:d} entries"]
+
+def disassemble(code):
+    full_assembly = []
+    opcodes_old = ["ld ", "st ", "add", "sub", "inv", "lsl", "lsr", "and", "or ", "slt", "", "beq", "bne", "jmp", "lui", "lli"]
 
+    line_number = 0
+
+    # Pass 1 - add all labels to the label table
+    label_names = find_labels(code)
    
     # Pass 2 - disassemble
     for line in code:
-        comment = ""
-        assembly = ""
-
-        # remove anything between braces {}
-        brace_start = line.find("{")
-        brace_end  = line.find("}")
-        if brace_start > -1 and brace_end > -1:
-            line = line[:brace_start] + line[brace_end + 1:]
-
-        # split on comment //
-        line = line.strip()        
-        comment_location = line.find("//")
-        if comment_location > -1:
-            comment = line[comment_location :]
-            line = line[:comment_location]
+        line, comment, comment_location = split_line(line)
             
         # check for a label in a comment (at start of comment) // [xxx:yy]
         if comment_location == 0:
@@ -142,156 +334,566 @@ def disassemble(code):
             
         # otherwise process the line for disassembly    
         elif line != "":
-            value = int(line, 2)
-
-            opcode = get_bits(value, 0, 6)
-            rd     = get_bits(value, 7, 11)
-            func3  = get_bits(value, 12, 14)
-            rs1    = get_bits(value, 15, 19)
-            rs2    = get_bits(value, 20, 24)
-            func7  = get_bits(value, 25, 31)
-           
-            #opcode = opcode >> 2 # drop bottom two bits as not needed
-            
-            sign      = get_bits(value, 31, 31)   # 1 bit
-            val_30_20 = get_bits(value, 20, 30)   # 11 bits
-            val_30_25 = get_bits(value, 25, 30)   # 6 bits
-            val_24_21 = get_bits(value, 21, 24)   # 5 bits
-            val_20    = get_bits(value, 20, 20)   # 1 bit                     
-            val_19_12 = get_bits(value, 12, 19)   # 8 bits
-            val_11_8  = get_bits(value, 8, 11)    # 4 bits
-            val_7     = get_bits(value, 7, 7)     # 1 bit
-                                
-            imm_I = (sign_extend(sign, 21) << 11) + val_30_20
-            imm_S = (sign_extend(sign, 21) << 11) + (val_30_25 << 5)  + (val_11_8 << 1)  + val_7
-            imm_B = (sign_extend(sign, 20) << 12) + (val_7 << 11)     + (val_30_25 << 5) + (val_11_8 << 1)
-            imm_U = (sign << 31)                  + (val_30_20 << 20) + (val_19_12 << 12)
-            imm_J = (sign_extend(sign, 12) << 20) + (val_19_12 << 12) + (val_20 << 11)   + (val_30_25 << 5) + (val_24_21 << 1)
-           
-            signed_imm_I  = twos_complement_to_int(imm_I, 32)
-            signed_imm_S  = twos_complement_to_int(imm_S, 32)
-            signed_imm_B  = twos_complement_to_int(imm_B, 32)
-            signed_imm_U  = twos_complement_to_int(imm_U, 32)
-            signed_imm_J  = twos_complement_to_int(imm_J, 32)
-            
-            # and process all the optional registers and value
-
-
-            if   opcode == 0b01100_11:
-                # arithmetic r type
-                arith_r_cmds = ["add", "sll", "slt", "sltu", "xor",
-                                "srl", "or",  "and", "sub",  "",
-                                "",    "",    "",    "sra"]
-                ind = (func7 >> 2) + func3
-                assembly = arith_r_cmds[ind] + "\t"
-                assembly += f"x{rd:d}, x{rs1:d}, x{rs2:d}"
-            elif opcode == 0b00100_11:
-                # arithmetic i type
-                arith_i_cmds = ["addi", "slli", "slti", "sltiu", "xori",
-                                "srli", "ori",  "andi", "",  "",
-                                "",    "",    "",    "srai"]
-                # check for the three shift instructions with 5 bit immediate
-                if (func3 == 1 or func3 == 5):
-                    ind = (func7 >> 2) + func3
-                    assembly = arith_i_cmds[ind] + "\t"
-                    assembly += f"x{rd:d}, x{rs1:d}, {imm_I & 31:d}"
-                else:
-                    assembly = arith_i_cmds[func3] + "\t"
-                    assembly += f"x{rd:d}, x{rs1:d}, {signed_imm_I:d}"
-            elif opcode == 0b00000_11:
-                # load
-                load_cmds = ["lb", "lh", "lw", "", "lbu", "lhu"]
-                assembly = load_cmds[func3] + "\t"
-                assembly += f"x{rd:d}, {signed_imm_I:d}(x{rs1:d})"                 
-            elif opcode == 0b01000_11:
-                # store
-                store_cmds = ["sb", "sh", "sw"]
-                assembly = store_cmds[func3] + "\t"
-                assembly += f"x{rs2:d}, {signed_imm_S:d}(x{rs1:d})" 
-            elif opcode == 0b11000_11:
-                # branch
-                branch_cmds = ["beq", "bne", "", "", "blt", "bge", "bltu", "bgeu"]
-                assembly = branch_cmds[func3] + "\t"
-                assembly += f"x{rs1:d}, x{rs2:d}, {signed_imm_B:d}" 
-            elif opcode == 0b11001_11:
-                # jalr
-                assembly = "jalr" + "\t"
-                assembly += f"x{rd:d}, {signed_imm_I:d}(x{rs1:d})"                
-            elif opcode == 0b11011_11:
-                # jal
-                assembly = "jal" + "\t"
-                assembly += f"x{rd:d}, {signed_imm_J:d}"
-                
-            elif opcode == 0b01101_11:
-                # lui
-                assembly = "lui" + "\t"
-                shift_imm = signed_imm_U >> 12
-                assembly += f"x{rd:d}, {shift_imm:d}"    
-            elif opcode == 0b00101_11:
-                # auipc
-                assembly = "auipc" + "\t"
-                shift_imm = signed_imm_U >> 12
-                assembly += f"x{rd:d}, {shift_imm:d}" 
-
-
             # create the output with the assembly plus a comment
             # (which could be empty)
-            output = f"{assembly:25s}" + comment
+            output = assembly_text(int(line, 2)) + comment
  
             full_assembly.append((line_number, output))
             line_number += 4
             
     return full_assembly
 
+# Bulk decoding with NumPy - for whole memory dumps
+# Every field and all five immediates are worked out for all the words at once with
+# whole array operations, and each word is classified by looking its funct7, funct3
+# and opcode bits up in the sorted keys of decode_table
+# numpy is imported when this is first used and is not needed for anything else
+# disassemble_word() stays the reference - bulk_disassemble() gives the same text,
+# which check_bulk.py checks
+
+decode_fields = ("opcode", "rd", "funct3", "rs1", "rs2", "funct7",
+                 "imm_I", "imm_S", "imm_B", "imm_U", "imm_J")
+
+# operands: (format string, the fields it takes)
+operand_templates = {
+    operands_R:      ("x{:d}, x{:d}, x{:d}", ("rd", "rs1", "rs2")),
+    operands_I:      ("x{:d}, x{:d}, {:d}",  ("rd", "rs1", "imm_I")),
+    operands_Ishift: ("x{:d}, x{:d}, {:d}",  ("rd", "rs1", "rs2")),
+    operands_load:   ("x{:d}, {:d}(x{:d})",  ("rd", "imm_I", "rs1")),
+    operands_S:      ("x{:d}, {:d}(x{:d})",  ("rs2", "imm_S", "rs1")),
+    operands_B:      ("x{:d}, x{:d}, {:d}",  ("rs1", "rs2", "imm_B")),
+    operands_J:      ("x{:d}, {:d}",         ("rd", "imm_J")),
+    operands_U:      ("x{:d}, {:d}",         ("rd", "imm_U")),
+}
+
+spec_names = list(decode_specs)
+decode_arrays = None
+
+# numpy imports the standard library dis through inspect, and this file is also called
+# dis - so while numpy loads, this directory is taken off the path and this module out
+# of sys.modules, or numpy would find this file instead
+def import_numpy():
+    if "numpy" in sys.modules:
+        return sys.modules["numpy"]
+    here = os.path.dirname(os.path.abspath(__file__))
+    path = sys.path[:]
+    ours = sys.modules.get("dis")
+    if ours != None and os.path.dirname(os.path.abspath(getattr(ours, "__file__", "") or "")) == here:
+        del sys.modules["dis"]
+    else:
+        ours = None
+    sys.path[:] = [p for p in path if os.path.abspath(p or ".") != here]
+    try:
+        import numpy
+    finally:
+        sys.path[:] = path
+        if ours != None:
+            sys.modules["dis"] = ours
+    return numpy
+
+# the sorted table keys and the decode_specs index for each, built on first use
+def get_decode_arrays():
+    global decode_arrays
+    if decode_arrays == None:
+        np = import_numpy()
+        index = {name: i for i, name in enumerate(spec_names)}
+        keys = sorted(decode_table)
+        decode_arrays = (np.array(keys, dtype=np.uint32),
+                         np.array([index[decode_table[key][0][:-1]] for key in keys], dtype=np.int32))
+    return decode_arrays
+
+# Returns a dict of arrays with one element per word - the fields and immediates in
+# decode_fields, and "spec", the index of the word's mnemonic in decode_specs or -1
+# For callers that analyse the words and never need the text
+
+def decode_array(words):
+    np = import_numpy()
+    w = np.asarray(words, dtype=np.uint32)
+    v = w.astype(np.int64)
+
+    d = {"opcode": v & 0x7f, "rd": (v >> 7) & 31, "funct3": (v >> 12) & 7,
+         "rs1": (v >> 15) & 31, "rs2": (v >> 20) & 31, "funct7": (v >> 25) & 0x7f}
+    d["imm_I"] = ((v >> 20) ^ 0x800) - 0x800
+    d["imm_S"] = ((((v >> 20) & 0xfe0) | ((v >> 7) & 0x1f)) ^ 0x800) - 0x800
+    d["imm_B"] = ((((v >> 19) & 0x1000) | ((v << 4) & 0x800) | ((v >> 20) & 0x7e0) | ((v >> 7) & 0x1e)) ^ 0x1000) - 0x1000
+    d["imm_U"] = ((v >> 12) ^ 0x80000) - 0x80000
+    d["imm_J"] = ((((v >> 11) & 0x100000) | (v & 0xff000) | ((v >> 9) & 0x800) | ((v >> 20) & 0x7fe)) ^ 0x100000) - 0x100000
+
+    keys, specs = get_decode_arrays()
+    key = w & np.uint32(DECODE_MASK)
+    position = np.minimum(np.searchsorted(keys, key), len(keys) - 1)
+    d["spec"] = np.where(keys[position] == key, specs[position], -1)
+    return d
+
+# The same text as disassemble_word() for each word, formatted one mnemonic at a time
+def bulk_disassemble(words):
+    np = import_numpy()
+    d = decode_array(words)
+    text = [""] * len(d["spec"])
+    for i, name in enumerate(spec_names):
+        positions = np.flatnonzero(d["spec"] == i)
+        if len(positions) == 0:
+            continue
+        template, fields = operand_templates[decode_specs[name][3]]
+        prefix = name + "\t"
+        columns = [d[field][positions].tolist() for field in fields]
+        for position, values in zip(positions.tolist(), zip(*columns)):
+            text[position] = prefix + template.format(*values)
+    return text
+
+# disassemble() with the words decoded in bulk - the same result
+def disassemble_bulk(code):
+    lines = []
+    words = []
+    for line in code:
+        line, comment, comment_location = split_line(line)
+        if comment_location == 0:
+            label_start = comment.find("[")
+            label_end = comment.find(":")
+            if label_start > -1 and label_end > -1:
+                lines.append((None, comment[label_start + 1 : label_end + 1]))
+            else:
+                lines.append((None, comment))
+        elif line != "":
+            words.append(int(line, 2))
+            lines.append((len(words) - 1, comment))
+
+    text = bulk_disassemble(words)
+    full_assembly = []
+    for index, output in lines:
+        if index == None:
+            full_assembly.append((None, output))
+        else:
+            full_assembly.append((index * 4, f"{text[index]:25s}" + output))
+    return full_assembly
+
+# NDJSON listing - one JSON object per instruction, for tools that would otherwise parse .lrs
+# fields are the fixed position bit fields of the word, whichever format it is
+# operands are the registers then the immediate, the same order as the assembler's records
+# source_line is the line in the machine code file
+
+_OPERAND_RE = re.compile(r"x\d+|-?\d+")
+
+def word_fields(word):
+    return {"opcode": get_bits(word, 0, 6),   "rd":  get_bits(word, 7, 11),
+            "funct3": get_bits(word, 12, 14), "rs1": get_bits(word, 15, 19),
+            "rs2":    get_bits(word, 20, 24), "funct7": get_bits(word, 25, 31)}
+
+# label_names is address: label - the // [label:address] comments are used if not given
+
+def json_records(code, label_names=None):
+    if label_names == None:
+        label_names = find_labels(code)
+    address = 0
+    for source_line, line in enumerate(code):
+        line, comment, comment_location = split_line(line)
+        if comment_location == 0 or line == "":
+            continue
+        word = int(line, 2)
+        mnemonic, _, operand_text = disassemble_word(word).partition("\t")
+        operands = _OPERAND_RE.findall(operand_text)
+        registers = [op for op in operands if op[0] == "x"]
+        values = [int(op) for op in operands if op[0] != "x"]
+        yield {"address": address, "word": word, "fields": word_fields(word),
+               "mnemonic": mnemonic, "operands": registers + values, "source_line": source_line + 1,
+               "label": label_names.get(address), "comment": comment}
+        address += 4
+
+# "-" writes to stdout - records are written as they are generated
+def write_ndjson(filename, records):
+    f = sys.stdout if filename == "-" else cache.open_new(filename)
+    for record in records:
+        f.write(json.dumps(record) + "\n")
+    if f != sys.stdout:
+        f.close()
+
+# Binary and $readmemh input - for memory dumps too big to hold as text
+# Both are generators of (address, word, comment), with (None, None, text) for a
+# label or comment line, so a dump is decoded a word at a time in constant memory
+
+# Raw little endian words, as written by ass.py --format bin
+# the file is memory mapped and read as 32 bit words through a memoryview, with no copy
+# a last part word is padded with zero bytes
+# every view is released on the way out, even if the generator is closed early,
+# as the mapping cannot be closed while a view of it exists
+
+def binary_words(filename, address=0):
+    with open(filename, mode='rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        whole = size - size % 4
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as raw:
+            if sys.byteorder == "little":
+                with raw[:whole] as part, part.cast("I") as words:
+                    for word in words:
+                        yield address, word, ""
+                        address += 4
+            else:
+                for offset in range(0, whole, 4):
+                    yield address, int.from_bytes(raw[offset : offset + 4], "little"), ""
+                    address += 4
+            if whole < size:
+                yield address, int.from_bytes(bytes(raw[whole:]) + bytes(4 - size % 4), "little"), ""
+
+# a whole line comment is a label line if it is a // [label:address] comment
+def comment_entry(comment):
+    label_start = comment.find("[")
+    label_end = comment.find(":")
+    if label_start > -1 and label_end > -1:
+        return None, None, comment[label_start + 1 : label_end + 1]
+    return None, None, comment
+
+# $readmemh text, as written by ass.py --format hex - one hex word per value, "_" allowed,
+# @ sets the word address, and a // [label:address] comment gives a label line
+
+def readmemh_words(filename):
+    address = 0
+    with open(filename, mode='r') as f:
+        for line in f:
+            line, comment, comment_location = split_line(line)
+            if comment_location == 0:
+                yield comment_entry(comment)
+                continue
+            for token in line.split():
+                if token[0] == "@":
+                    address = int(token[1:].replace("_", ""), 16) * 4
+                else:
+                    yield address, int(token.replace("_", ""), 16), comment
+                    address += 4
+
+# The same entries from .mc lines
+def mc_words(code):
+    address = 0
+    for line in code:
+        line, comment, comment_location = split_line(line)
+        if comment_location == 0:
+            yield comment_entry(comment)
+        elif line != "":
+            yield address, int(line, 2), comment
+            address += 4
+
+# disassemble() for (address, word, comment) entries - yields the same (address, output)
+def disassemble_words(entries):
+    for address, word, comment in entries:
+        if word == None:
+            yield None, comment
+        else:
+            yield address, assembly_text(word) + comment
+
+# Control flow recovery - for machine code with few or no label comments
+# The target of every branch and jal in the image gets a label, loc_{address} unless
+# a label comment or the .sym file already names it, and the branch or jal is written
+# with the label instead of the offset - so the .rsc assembles to the same words
+# and still does if it is edited and the code moves
+# The code is also split into basic blocks, each starting at address 0, a target,
+# or the instruction after a branch, jal or jalr
+
+# Two passes over the entries, so the work and memory are linear in the size of the image
+# with the targets and block starts held in sets - nothing is sorted or searched
+
+BRANCH_OPCODE = 0b11000_11
+JAL_OPCODE    = 0b11011_11
+JALR_OPCODE   = 0b11001_11
+
+# The address a branch or jal goes to, or None for any other word
+def branch_target(address, word):
+    opcode = word & 0x7f
+    if opcode == JAL_OPCODE:
+        return address + imm_J(word)
+    if opcode == BRANCH_OPCODE and (word & DECODE_MASK) in decode_table:
+        return address + imm_B(word)
+    return None
+
+# Pass 1 - returns the flow, a dict of
+#   labels   address: label for every address with a label, from the entries, then
+#            label_names (address: label, as from the .sym file), then made up for targets
+#   listed   addresses whose labels are already label lines in the entries
+#   leaders  addresses that start a basic block
+#   exits    address of each branch, jal and jalr: [successor addresses], None for jalr's
+#            register target - a jal or jalr that links returns to the next address so it
+#            is a successor
+#   size     bytes of code
+#   targets  branch and jal targets in the code
+#   addresses  address of each word, in the order read - $readmemh @ can leave gaps
+
+def find_control_flow(entries, label_names=None):
+    labels = {}
+    pending = []
+    exits = {}
+    targets = set()
+    addresses = []
+    size = 0
+    for address, word, comment in entries:
+        if word == None:
+            if comment[:2] != "//" and comment[-1:] == ":":
+                pending.append(comment[:-1])
+            continue
+        if pending:
+            labels.setdefault(address, pending[0])
+            pending = []
+        size = max(size, address + 4)
+        addresses.append(address)
+        target = branch_target(address, word)
+        if target != None:
+            targets.add(target)
+            if word & 0x7f == BRANCH_OPCODE or (word >> 7) & 31 != 0:
+                exits[address] = [target, address + 4]
+            else:
+                exits[address] = [target]
+        elif word & 0x7f == JALR_OPCODE:
+            if (word >> 7) & 31 != 0:
+                exits[address] = [None, address + 4]
+            else:
+                exits[address] = [None]
+
+    listed = set(labels)
+    for address, label in (label_names or {}).items():
+        labels.setdefault(address, label)
+
+    # only a target in the code can be labelled - any other stays an offset
+    present = set(addresses)
+    targets = {target for target in targets if target in present}
+    present = None
+    names = set(labels.values())
+    for target in targets:
+        if target not in labels:
+            label = f"loc_{target:d}"
+            while label in names:
+                label += "_"
+            labels[target] = label
+            names.add(label)
+
+    leaders = {0} | targets | {address + 4 for address in exits if address + 4 < size}
+    return {"labels": labels, "listed": listed, "leaders": leaders, "exits": exits,
+            "size": size, "targets": targets, "addresses": addresses}
+
+# Pass 2 - disassemble_words() with a label line before each labelled address that the
+# entries do not have one for, and branch and jal targets written as labels
+
+def flow_disassemble(entries, flow):
+    labels = flow["labels"]
+    listed = flow["listed"]
+    for address, word, comment in entries:
+        if word == None:
+            yield None, comment
+            continue
+        if address in labels and address not in listed:
+            yield None, labels[address] + ":"
+        target = branch_target(address, word)
+        if target in labels:
+            mnemonic, operands = decode_table[word & DECODE_MASK]
+            if word & 0x7f == JAL_OPCODE:
+                text = f"{mnemonic:s}x{(word >> 7) & 31:d}, {labels[target]:s}"
+            else:
+                text = f"{mnemonic:s}x{(word >> 15) & 31:d}, x{(word >> 20) & 31:d}, {labels[target]:s}"
+            yield address, f"{text:25s}" + comment
+        else:
+            yield address, assembly_text(word) + comment
+
+# The basic blocks as [(start, end, successors)] in the order the words were read
+# end is the address after the block and successors are as in exits, or the next block
+# if the code runs on into it - a block also ends at a gap in the addresses, with no
+# successor as there is no code in the gap to run on into
+def basic_blocks(flow):
+    leaders = flow["leaders"]
+    exits = flow["exits"]
+    addresses = flow["addresses"]
+    blocks = []
+    for n, address in enumerate(addresses):
+        if n == 0 or addresses[n - 1] + 4 != address or address in leaders or addresses[n - 1] in exits:
+            start = address
+        end = address + 4
+        following = addresses[n + 1] if n + 1 < len(addresses) else None
+        if address in exits:
+            blocks.append((start, end, exits[address]))
+        elif following != end:
+            blocks.append((start, end, []))
+        elif end in leaders:
+            blocks.append((start, end, [end]))
+    return blocks
+
+# The block map - one line per block
+# {start} {end} {label or -} -> {successor labels or addresses, indirect for a jalr}
+
+def block_listing(blocks, labels):
+    lines = ["// start  end     label                -> successors"]
+    for start, end, successors in blocks:
+        names = []
+        for successor in successors:
+            if successor == None:
+                names.append("indirect")
+            else:
+                names.append(labels.get(successor, str(successor)))
+        lines.append(f"{start:<8d} {end:<8d} {labels.get(start, '-'):20s} -> {' '.join(names):s}")
+    return lines
+
+# The .rsc and .lrs text for a disassemble() result
+# returns (rsc lines, lrs lines) - the .lrs lines are also what goes to the screen
+
+def rsc_listing(full_assembly):
+    rsc = []
+    lrs = []
+    for line_no, line in full_assembly:
+        if line_no != None:
+            rsc.append(f"          {line:s}")
+            lrs.append(f"{line_no:<4d}      {line:s}")
+        else:
+            rsc.append(line)
+            lrs.append(line)
+    return rsc, lrs
+
 ##############################################################
 
-import sys, os
-
-if len(sys.argv) > 1:
-    filename = sys.argv[1]
-    splitname = filename.split(".")
-    outname1 = splitname[0] +".rsc"
-    outname2 = splitname[0] +".lrs"
-else:
-    #filename = "test1.mc"
-    filename = "risc_test.mc"
-    outname1 = None
-
-f = open(filename, mode='r')
-code = f.readlines()
-f.close()
-code_clean =[line.strip() for line in code]
-
-
-ass = disassemble(code_clean)
-
-# helper to reduce number of checks on files in the main loop
-def printfile(txt, f):
-    if f != None:
-        print(txt, file = f)
-        
-# Print out the result
-
-if outname1:
-    f1 = open(outname1, mode='w')
-    f2 = open(outname2, mode='w')
-else:
-    f1 = None
-    f2 = None
-
-for line_no, line in ass:
-    if line_no != None:
-        s1 = f"          {line:s}"
-        s2 = f"{line_no:<4d}      {line:s}"
-        print(s2)
-        printfile(s1, f1)
-        printfile(s2, f2)
+# Command line
+# python dis.py {machine code file} - disassemble to the screen and to .rsc and .lrs files
+
+def write_lines(filename, lines):
+    f = cache.open_new(filename)
+    f.write("\n".join(lines))
+    if lines:
+        f.write("\n")
+    f.close()
+
+# Write each (filename, lines) with one write per file
+# several files are written at the same time from threads as the writes release the GIL
+
+def write_files(outputs):
+    if len(outputs) < 2:
+        for filename, lines in outputs:
+            write_lines(filename, lines)
+        return
+    with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+        for done in [executor.submit(write_lines, filename, lines) for filename, lines in outputs]:
+            done.result()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Disassemble a RISC V machine code file into .rsc and .lrs files")
+    parser.add_argument("filename", nargs="?", help="machine code file, risc_test.mc to the screen only if missing")
+    parser.add_argument("--input", choices=["mc", "hex", "bin"],
+                        help="mc: .mc binary text, hex: $readmemh, bin: raw little endian words - "
+                             "default from the extension, .hex and .bin, else mc")
+    parser.add_argument("--cache", metavar="DIR", help="build cache directory - an unchanged file reuses its outputs")
+    parser.add_argument("--cache-size", type=int, default=256, metavar="MB", help="build cache size limit")
+    parser.add_argument("--link", action="store_true", help="hard link outputs from the build cache instead of copying - do not edit them in place")
+    parser.add_argument("--quiet", action="store_true", help="do not echo the listing to the screen")
+    parser.add_argument("--bulk", action="store_true", help="decode all the words at once with numpy - for large files")
+    parser.add_argument("--decode-cache", type=int, default=decode_cache_size, metavar="N",
+                        help="number of decoded words to keep, 0 for no cache")
+    parser.add_argument("--stats", action="store_true", help="print the decode cache statistics")
+    parser.add_argument("--ndjson", metavar="FILE",
+                        help="also write one JSON object per instruction to FILE, - for stdout - not used with --cache")
+    parser.add_argument("--sym", metavar="FILE",
+                        help="take the labels for --ndjson and --cfg from the assembler's .sym file rather than the listing comments")
+    parser.add_argument("--cfg", action="store_true",
+                        help="label every branch and jal target and write the basic block map to {filename}.blk")
+    args = parser.parse_args(argv)
+
+    if args.filename:
+        filename = args.filename
+        basename = os.path.splitext(filename)[0]
+        outname1 = basename + ".rsc"
+        outname2 = basename + ".lrs"
+        outname3 = basename + ".blk"
     else:
-        print(line)
-        printfile(line, f1)
-        printfile(line, f2)
+        #filename = "test1.mc"
+        filename = "risc_test.mc"
+        outname1 = None
+
+    input_format = args.input
+    if input_format == None:
+        input_format = {".hex": "hex", ".bin": "bin"}.get(os.path.splitext(filename)[1], "mc")
+    if args.cfg and args.bulk:
+        parser.error("--cfg does not use --bulk")
+
+    label_names = sym.section_labels(sym.load_sym(args.sym)) if args.sym else None
+
+    # hex and binary dumps are decoded as they are read and the listing written a line
+    # at a time, so memory use does not grow with the size of the dump
+    # --cfg reads them twice, once to find the targets and once to write the listing
+    if input_format != "mc":
+        if args.bulk or args.ndjson or args.cache:
+            parser.error("--bulk, --ndjson and --cache only read .mc files")
+        set_decode_cache_size(args.decode_cache)
+        def read_entries():
+            if input_format == "bin":
+                return binary_words(filename)
+            return readmemh_words(filename)
+        if args.cfg:
+            flow = find_control_flow(read_entries(), label_names)
+            listing = flow_disassemble(read_entries(), flow)
+            if outname1:
+                write_lines(outname3, block_listing(basic_blocks(flow), flow["labels"]))
+        else:
+            listing = disassemble_words(read_entries())
+        f1 = cache.open_new(outname1) if outname1 else None
+        f2 = cache.open_new(outname2) if outname1 else None
+        for line_no, line in listing:
+            if line_no != None:
+                s1 = f"          {line:s}\n"
+                s2 = f"{line_no:<4d}      {line:s}\n"
+            else:
+                s1 = s2 = line + "\n"
+            if f1:
+                f1.write(s1)
+                f2.write(s2)
+            if not args.quiet:
+                sys.stdout.write(s2)
+        if f1:
+            f1.close()
+            f2.close()
+        if args.stats:
+            for line in decode_cache_report():
+                print(line)
+        return
+
+    # build cache - keyed on the machine code contents, only when writing files
+    # the .sym file is not part of the key, so --sym is not cached either
+    key = None
+    if args.cache and outname1 and not args.ndjson and not args.sym:
+        outnames = [outname1, outname2, outname3] if args.cfg else [outname1, outname2]
+        f = open(filename, mode='rb')
+        key = cache.cache_key(f.read(), "dis", VERSION, __file__, "cfg" if args.cfg else "")
+        f.close()
+        if cache.cache_fetch(args.cache, key, outnames, args.link):
+            print(f"{', '.join(outnames):s} from cache")
+            return
+
+    f = open(filename, mode='r')
+    code = f.readlines()
+    f.close()
+    code_clean =[line.strip() for line in code]
+
+
+    set_decode_cache_size(args.decode_cache)
+    outputs = []
+    if args.bulk:
+        ass = disassemble_bulk(code_clean)
+    elif args.cfg:
+        flow = find_control_flow(mc_words(code_clean), label_names)
+        ass = list(flow_disassemble(mc_words(code_clean), flow))
+        if outname1:
+            outputs.append((outname3, block_listing(basic_blocks(flow), flow["labels"])))
+    else:
+        ass = disassemble(code_clean)
+
+    if args.ndjson:
+        write_ndjson(args.ndjson, json_records(code_clean, label_names))
+
+    # Write each file once, then the listing to the screen in one write
+    rsc, lrs = rsc_listing(ass)
+    if outname1:
+        write_files([(outname1, rsc), (outname2, lrs)] + outputs)
+    if not args.quiet and lrs:
+        sys.stdout.write("\n".join(lrs) + "\n")
+
+    if args.stats:
+        for line in decode_cache_report():
+            print(line)
+
+    if key:
+        cache.cache_store(args.cache, key, outnames, args.cache_size * 1024 * 1024)
 
-if outname1:        
-    f1.close()
-    f2.close()
 
+if __name__ == "__main__":
+    main()
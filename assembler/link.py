@@ -0,0 +1,118 @@
+# Linker - combines relocatable objects (.rso) from ass.py --format rso into one program
+
+# Example:
+
+# python ass.py lib.rscin --format rso
+# python ass.py main.rscin --format rso
+# python link.py main.rso lib.rso -o prog       writes prog.mc and prog.lmc
+
+# The code of each object follows the one before it, in the order given, and so
+# does its data, aligned to a word
+# Labels are global - a relocation is resolved against the object that defines the
+# label, and it is an error if no object or more than one object does
+# A code label is pc relative and a data label is the absolute data address,
+# just as assemble() does for a single source
+
+import os, sys, json, argparse
+
+try:
+    from . import ass
+except ImportError:
+    import ass
+
+
+def read_object(filename):
+    f = open(filename, mode='r')
+    obj = json.load(f)
+    f.close()
+    if obj.get("version") != ass.OBJECT_VERSION:
+        raise ValueError(f"{filename:s} is not a version {ass.OBJECT_VERSION:d} object")
+    return obj
+
+# Returns (result, data) - result is as from assemble(), data is the data image
+# raises KeyError for an undefined label, and ValueError for one defined twice
+# or for a branch or jal that cannot reach its label - objects are not relaxed across modules
+
+def link(objects):
+    text_bases = []
+    data_bases = []
+    text_bytes = 0
+    data = bytearray()
+    for obj in objects:
+        text_bases.append(text_bytes)
+        text_bytes += obj["text_bytes"]
+        data += bytes(-len(data) % 4)
+        data_bases.append(len(data))
+        data += bytes.fromhex(obj["data"])
+
+    # global symbol table - label: [(section, address)] with one entry per definition
+    symbols = {}
+    for obj, text_base, data_base in zip(objects, text_bases, data_bases):
+        for section, base in (("text", text_base), ("data", data_base)):
+            for label, address in obj["symbols"][section].items():
+                symbols.setdefault(label, []).append((section, base + address))
+
+    result = []
+    for obj, text_base, data_base in zip(objects, text_bases, data_bases):
+        part = [[address + text_base, label, word, comment] for address, label, word, comment in obj["result"]]
+        for index, fmt, kind, target in obj["relocations"]:
+            entry = part[index]
+            if entry[2] == None or entry[2] == ass.ERROR:
+                continue
+            if kind == "data":
+                value = data_base + target
+            elif kind == "text":
+                value = text_base + target
+            else:
+                if target not in symbols:
+                    raise KeyError(target)
+                if len(symbols[target]) > 1:
+                    raise ValueError(f"{target:s} is defined in more than one object")
+                section, address = symbols[target][0]
+                value = address - entry[0] if section == "text" and kind == "symbol" else address
+            if kind in ("text", "address"):
+                limits = ass.offset_limits["la"]
+            else:
+                limits = ass.format_limits.get(fmt)
+            if limits and not ass.in_range(limits, value):
+                raise ValueError(f"{target} is out of range of the instruction at {entry[0]:d}")
+            encode = ass.imm_encoders[fmt]
+            entry[2] = (entry[2] & ~encode(-1)) | encode(value)
+        result += [tuple(entry) for entry in part]
+
+    return result, data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Link relocatable objects into .mc and .lmc files")
+    parser.add_argument("objects", nargs="+", help=".rso files from ass.py --format rso, in address order")
+    parser.add_argument("-o", "--output", help="output name without extension, default is the first object's")
+    parser.add_argument("--ram", action="store_true", help="write the data to the four bank files {output}_ramA.mem to _ramD.mem")
+    parser.add_argument("--ram-word", action="store_true", help="write the data to the word wide file {output}_mem_word.mem")
+    parser.add_argument("--quiet", action="store_true", help="do not echo the listing to the screen")
+    args = parser.parse_args(argv)
+
+    basename = args.output or os.path.splitext(args.objects[0])[0]
+    try:
+        result, data = link([read_object(filename) for filename in args.objects])
+    except KeyError as e:
+        print(f"ERROR undefined label {e}")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"ERROR {e}")
+        sys.exit(1)
+
+    mc, lmc = ass.mc_listing(result)
+    outputs = [(basename + ".mc", mc), (basename + ".lmc", lmc)]
+    if args.ram:
+        outputs += zip([basename + "_ram" + bank + ".mem" for bank in "ABCD"], ass.ram_banks(data))
+    if args.ram_word:
+        outputs.append((basename + "_mem_word.mem", ass.ram_word_listing(data)))
+    ass.write_files(outputs)
+
+    if not args.quiet:
+        ass.write_screen(lmc)
+
+
+if __name__ == "__main__":
+    main()
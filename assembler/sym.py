@@ -0,0 +1,160 @@
+# Symbol table and source map sidecar (.sym) written by the assembler
+
+# Holds the labels, the pc to source line map and the section layout so a tool
+# can resolve an address with a binary search instead of scanning listing text
+
+# File layout - all numbers are 32 bit unsigned little endian
+# header     "RSYM", version, section count, symbol count, line count, string table bytes
+# sections   name offset, start, size, first symbol, symbol count    - one per section
+# symbols    addresses, then name offsets, then name order            - one array each
+#            sorted by section then address, name order is the symbol indexes sorted by name
+# lines      pcs, then source lines                                   - sorted by pc
+# strings    the names, each ending in a zero byte
+
+# Sections are "text" and "data" - each starts at 0 as they are separate memories
+
+# Example:
+
+# sym = load_sym("risc_test.sym")
+# symbol_at(sym, 0x24)         ("loop", 8)
+# symbol_address(sym, "loop")  ("text", 28)
+# source_line(sym, 0x24)       31
+
+import sys, struct
+from array import array
+from bisect import bisect_left, bisect_right
+
+try:
+    from . import cache
+except ImportError:
+    import cache
+
+
+MAGIC = b"RSYM"
+SYM_VERSION = 1
+
+_HEADER = struct.Struct("<4sIIIII")
+
+def to_bytes(values):
+    values = array("I", values)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+def from_bytes(data, offset, count):
+    values = array("I")
+    values.frombytes(data[offset : offset + count * 4])
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values, offset + count * 4
+
+# sections: [(name, size)]
+# symbols:  [(name, section name, address)]
+# lines:    [(pc, source line)] - source lines count from 1
+
+def sym_image(sections, symbols, lines):
+    strings = bytearray()
+    string_offsets = {}
+    def string(name):
+        if name not in string_offsets:
+            string_offsets[name] = len(strings)
+            strings.extend(name.encode() + b"\0")
+        return string_offsets[name]
+
+    section_index = {name: i for i, (name, size) in enumerate(sections)}
+    symbols = sorted(symbols, key=lambda s: (section_index[s[1]], s[2], s[0]))
+
+    section_table = []
+    for i, (name, size) in enumerate(sections):
+        members = [n for n, s in enumerate(symbols) if section_index[s[1]] == i]
+        first = members[0] if members else len(symbols)
+        section_table += [string(name), 0, size, first, len(members)]
+
+    addresses = [address for name, section, address in symbols]
+    names = [string(name) for name, section, address in symbols]
+    name_order = sorted(range(len(symbols)), key=lambda n: symbols[n][0])
+
+    lines = sorted(lines)
+    pcs = [pc for pc, source_line in lines]
+    source_lines = [source_line for pc, source_line in lines]
+
+    return (_HEADER.pack(MAGIC, SYM_VERSION, len(sections), len(symbols), len(lines), len(strings))
+            + to_bytes(section_table) + to_bytes(addresses) + to_bytes(names) + to_bytes(name_order)
+            + to_bytes(pcs) + to_bytes(source_lines) + bytes(strings))
+
+def write_sym(filename, sections, symbols, lines):
+    f = cache.open_new(filename, mode='wb')
+    f.write(sym_image(sections, symbols, lines))
+    f.close()
+
+# Returns a dict of the arrays in the file - names are decoded once, at load
+
+def parse_sym(data):
+    magic, version, section_count, symbol_count, line_count, string_bytes = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != SYM_VERSION:
+        raise ValueError("not a version 1 .sym file")
+    offset = _HEADER.size
+    section_table, offset = from_bytes(data, offset, section_count * 5)
+    addresses, offset = from_bytes(data, offset, symbol_count)
+    name_offsets, offset = from_bytes(data, offset, symbol_count)
+    name_order, offset = from_bytes(data, offset, symbol_count)
+    pcs, offset = from_bytes(data, offset, line_count)
+    source_lines, offset = from_bytes(data, offset, line_count)
+    strings = data[offset : offset + string_bytes]
+
+    def string(at):
+        return strings[at : strings.index(b"\0", at)].decode()
+
+    sections = {}
+    for i in range(section_count):
+        name, start, size, first, count = section_table[i * 5 : i * 5 + 5]
+        sections[string(name)] = (start, size, first, count)
+
+    names = [string(at) for at in name_offsets]
+    symbol_sections = [None] * symbol_count
+    for name, (start, size, first, count) in sections.items():
+        symbol_sections[first : first + count] = [name] * count
+
+    return {"sections": sections, "addresses": addresses, "names": names,
+            "symbol_sections": symbol_sections, "sorted_names": [names[n] for n in name_order],
+            "name_order": name_order, "pcs": pcs, "source_lines": source_lines}
+
+def load_sym(filename):
+    f = open(filename, mode='rb')
+    data = f.read()
+    f.close()
+    return parse_sym(data)
+
+# Lookups - each is a binary search
+
+# The nearest symbol at or below address in a section, as (name, offset from it), or None
+def symbol_at(sym, address, section="text"):
+    if section not in sym["sections"]:
+        return None
+    start, size, first, count = sym["sections"][section]
+    n = bisect_right(sym["addresses"], address, first, first + count) - 1
+    if n < first:
+        return None
+    return sym["names"][n], address - sym["addresses"][n]
+
+# (section, address) of a symbol, or None
+def symbol_address(sym, name):
+    n = bisect_left(sym["sorted_names"], name)
+    if n == len(sym["sorted_names"]) or sym["sorted_names"][n] != name:
+        return None
+    index = sym["name_order"][n]
+    return sym["symbol_sections"][index], sym["addresses"][index]
+
+# The source line of the instruction at pc, or None
+def source_line(sym, pc):
+    n = bisect_right(sym["pcs"], pc) - 1
+    if n < 0 or sym["pcs"][n] != pc:
+        return None
+    return sym["source_lines"][n]
+
+# address: name for one section, as the disassembler's label table
+def section_labels(sym, section="text"):
+    if section not in sym["sections"]:
+        return {}
+    start, size, first, count = sym["sections"][section]
+    return {sym["addresses"][n]: sym["names"][n] for n in range(first, first + count)}